@@ -24,10 +24,15 @@
 #         return avg(node.rewards + values)
 
 import enum
+import multiprocessing
+import time
 import numpy as np
 from global_constants import print_debug
 from mdpSimulator import MDPSimulator
 
+# (node, action) pairs simulated between two deadline checks of a timed level
+BUDGET_CHUNK = 4096
+
 
 NodeType = enum.Enum("NodeType", "Outcome Decision")
 
@@ -49,6 +54,8 @@ class SparseTree(object):
         self.parent = parent
         self.actions = actions
         self.children = []
+        # outcome closed off with its analytic value, see close_terminals
+        self.terminal = False
 
     def add_child(self, child):
         self.children.append(child)
@@ -76,12 +83,156 @@ class SparseTree(object):
         return max(map(lambda child: child.get_tree_depth(), self.children))
 
 
+class StreamedSparseTree(SparseTree):
+    """Root of a tree that was evaluated depth first without being stored.
+    Only the root and its outcome children are kept, with the size and depth
+    of the full tree"""
+
+    def __init__(self, node, actions=None):
+        SparseTree.__init__(self, node, None, actions)
+        self.size = 1
+        self.depth = 0
+
+    def get_tree_size(self):
+        return self.size
+
+    def get_tree_depth(self):
+        return self.depth
+
+
+class ArraySparseTree(object):
+    """Struct-of-arrays sparse tree. Node type, depth, state, parent, reward,
+    action and value live in preallocated numpy arrays; the children of a node
+    are the contiguous index range child_start:child_start+child_count.
+    Nodes are stored level by level, levels[d] = (decision_start, decision_end,
+    outcome_start, outcome_end) for the nodes at depth d."""
+
+    def __init__(self, root_state, capacity=1024):
+        self.size = 0
+        self.capacity = 0
+        self.levels = []
+        self.actions = None
+        # nodes copied from the previous move's tree instead of simulated
+        self.reused_nodes = 0
+        # nodes grown and evaluated in worker processes, not stored here
+        self.remote_nodes = 0
+        # cells visited above each depth 0 decision, latest first, when the
+        # tree continues a path (SparseTreeEvaluator.evaluate_frontier)
+        self.root_paths = None
+        self.__allocate(capacity)
+        self.add_nodes(NodeType.Decision, 0, [root_state], [-1])
+        self.node = SparseTree.Node(NodeType.Decision, 0, root_state, [])
+
+    def __allocate(self, capacity):
+        def grow(name, shape, dtype, fill):
+            new = np.full(shape, fill, dtype=dtype)
+            if self.capacity:
+                new[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, new)
+        grow("type", capacity, np.int8, 0)
+        grow("depth", capacity, np.int16, 0)
+        grow("state", (capacity, 2), np.int32, 0)
+        grow("parent", capacity, np.int32, -1)
+        grow("reward", capacity, np.float64, 0.0)
+        grow("value", capacity, np.float64, np.nan)
+        grow("weight", capacity, np.float64, 1.0)
+        grow("action", capacity, np.int8, -1)
+        grow("child_start", capacity, np.int32, 0)
+        grow("child_count", capacity, np.int32, 0)
+        self.capacity = capacity
+
+    def add_nodes(self, type, depth, states, parents, rewards=None, actions=None, weights=None):
+        """ Appends len(parents) nodes of one type and depth, returns the index of the first """
+        n = len(parents)
+        start = self.size
+        if start + n > self.capacity:
+            self.__allocate(max(2 * self.capacity, start + n))
+        end = start + n
+        self.type[start:end] = type.value
+        self.depth[start:end] = depth
+        self.state[start:end] = np.asarray(states).reshape(-1, 2)
+        self.parent[start:end] = parents
+        if rewards is not None:
+            self.reward[start:end] = rewards
+        if actions is not None:
+            self.action[start:end] = actions
+        if weights is not None:
+            self.weight[start:end] = weights
+        self.size = end
+        return start
+
+    @property
+    def children(self):
+        # SparseTree views of the root's children, for printing
+        start, count = self.child_start[0], self.child_count[0]
+        return [SparseTree(SparseTree.Node(NodeType.Outcome, 0, tuple(self.state[i].tolist()),
+                                           [] if np.isnan(self.value[i]) else [float(self.value[i])]), self)
+                for i in range(start, start + count)]
+
+    def __str__(self):
+        children_str = "{"
+        for child in self.children:
+            children_str += " " + str(child.node)
+        children_str += "}"
+        return str(self.node) + " -> " + children_str
+
+    def get_tree_size(self):
+        # same count as SparseTree: childless outcome nodes are not counted
+        types = self.type[:self.size]
+        return int(np.sum((types == NodeType.Decision.value) | (self.child_count[:self.size] > 0))) + \
+               self.remote_nodes
+
+    def get_tree_depth(self):
+        return int(self.depth[:self.size].max())
+
+    def get_memory_usage(self):
+        return sum(getattr(self, name).nbytes for name in
+                   ("type", "depth", "state", "parent", "reward", "value", "weight",
+                    "action", "child_start", "child_count"))
+
+
+def predict_specials(state_posterior, times, loss_penalty):
+    """ The red specials at the cells state_posterior predicts, one set per time in times """
+    return [{(x, y, "red", loss_penalty, "NA") for x, y in state_posterior.predict_cells(time)}
+            for time in times]
+
+
+def get_level_specials(specials, depth, goal_state, goal_reward):
+    """ The specials a move at depth is simulated against: those predicted for depth,
+        depth + 1 and depth + 2 (specials[0] is one move before the root), and the goal """
+    specials_t = list(set(specials[depth]) |
+                      set(specials[depth + 1]) |
+                      set(specials[depth + 2]))
+    specials_t.append((goal_state[0], goal_state[1], "green", goal_reward, "NA"))
+    return specials_t
+
+
+def filter_root_specials(root_state, specials_t, ignored_specials):
+    """ specials_t without the non goal specials the root stands on, which are
+        added to ignored_specials """
+    # if we are at root node, and asked to evaluate decision tree
+    # we assume that special and tree root cannot overlap
+    # otherwise, there is no tree to construct
+    filtered_specials = specials_t.copy()
+    for idx, (i, j, c, r, v) in enumerate(specials_t):
+        if root_state[0] == i and root_state[1] == j:
+            print("Root at special", (i, j, c, r, v))
+            if not c == "green":
+                ignored_specials.append([i, j])
+                filtered_specials.pop(idx)
+    return filtered_specials
+
+
 class SparseTreeEvaluator(object):
 
         def __init__(self, mdp_simulator, root_state, action_set, horizon,
                      history_manager, state_posterior, goal_state, goal_reward,
                      loss_penalty, thompson_sampler=None,
-                     discount_factor=0.05):
+                     discount_factor=0.05, array_tree=False, transpositions=False,
+                     reuse_tree=False, n_workers=0, split_depth=1,
+                     time_budget=None, node_budget=None, branch_factor=None, streaming=False,
+                     stream_block=5, pruning=False, close_terminals=False, cycle_pruning=False,
+                     leaf_evaluator=None):
             self.simulator = mdp_simulator
             self.root_state = root_state
             self.action_set = action_set
@@ -95,17 +246,115 @@ class SparseTreeEvaluator(object):
             self.loss_penalty = loss_penalty
             self.goal_reward = goal_reward
             self.ignored_specials = []
+            # store the lookahead tree in numpy arrays (ArraySparseTree)
+            self.array_tree = array_tree or transpositions or reuse_tree or n_workers > 1 or \
+                              time_budget is not None or node_budget is not None or branch_factor is not None
+            # below the root, decision nodes with the same (state, depth) share
+            # one subtree, so the lookahead tree becomes a DAG
+            self.transpositions = transpositions
+            # keep the tree between moves and re-root it onto the reached child
+            self.reuse_tree = reuse_tree
+            self.specials = None
+            self.evaluated_at = None
+            # subtrees below split_depth are grown by a pool of n_workers processes
+            if n_workers > 1 and not 1 <= split_depth:
+                raise Exception("Split depth must be at least 1, the root level is always grown locally")
+            self.n_workers = n_workers
+            self.split_depth = split_depth
+            self.pool = None
+            # anytime mode: levels are only grown while the budget (seconds per
+            # evaluate, nodes per tree) allows, the deepest complete level is used
+            if n_workers > 1 and (time_budget is not None or node_budget is not None):
+                raise Exception("Anytime planning cannot be combined with a worker pool")
+            self.time_budget = time_budget
+            self.node_budget = node_budget
+            self.depth_reached = None
+            self.nodes_expanded = None
+            # seconds per node of the last leaf valuation and backup, held back
+            # from the time budget for the next one
+            self.backup_time = 0.0
+            # sparse sampling: every outcome averages over branch_factor specials
+            # configurations drawn from the posterior instead of its rounded mean.
+            # this approximates Kearns et al. sparse sampling: the configurations
+            # are drawn once per depth and shared by every node of that depth, and
+            # each action keeps a single child whose reward is their average,
+            # rather than C independently sampled children per (node, action)
+            self.branch_factor = branch_factor
+            # grow and evaluate depth first, keeping only the current path
+            if streaming and (transpositions or reuse_tree or n_workers > 1 or
+                              time_budget is not None or node_budget is not None):
+                raise Exception("Streaming evaluation keeps no tree to share, reuse, split or deepen")
+            # branch and bound below the root, on the depth first path
+            self.pruning = pruning
+            self.nodes_pruned = None
+            self.value_bounds = None
+            streaming = streaming or pruning
+            self.streaming = streaming
+            # the bottom stream_block levels below a node are grown as one small
+            # array tree, which bounds memory by horizon + 4^stream_block nodes
+            self.stream_block = stream_block
+            # outcomes landing on a special end the game, they are not expanded
+            # further but valued as standing on the special up to the horizon
+            if close_terminals and reuse_tree:
+                raise Exception("Closed terminal rewards depend on the depth, such a tree cannot be reused")
+            self.close_terminals = close_terminals
+            # below the root, moves back onto a cell of the current path are not
+            # expanded; the root move pool (thompson sampled) is left as it is
+            if cycle_pruning and (transpositions or reuse_tree or n_workers > 1):
+                raise Exception("Cycle pruning needs the path of every node, shared, reused or remote subtrees lose it")
+            self.cycle_pruning = cycle_pruning
+            # (node, action) pairs skipped for stepping back onto the cell just
+            # left, or onto an earlier cell of the path
+            self.backtracks_pruned = 0
+            self.revisits_pruned = 0
+            # value estimate of the decisions left unexpanded at the bottom of
+            # the tree (leafEvaluators), instead of nothing
+            self.leaf_evaluator = leaf_evaluator
+            # specials are predicted that many moves past the horizon, for the leaf evaluator
+            self.leaf_depth = leaf_evaluator.depth if leaf_evaluator is not None else 0
 
-        def evaluate(self, t):
-            root_node = SparseTree.Node(NodeType.Decision, 0, self.root_state, [])
-            lookahead_tree = SparseTree(root_node, None)
-            specials = []
-            for i in range(-1, self.horizon+2):
-                specials_t = []
-                self.__predict_specials(specials_t, t + i)
-                specials.append(set(specials_t))
-            self.__grow_sparse_tree(lookahead_tree, specials)
-            self.__eval_sparse_tree(lookahead_tree, specials)
+        def evaluate(self, t, root_state=None):
+            start_time = time.time()
+            if root_state is not None:
+                self.root_state = root_state
+            self.ignored_specials = []
+            self.backtracks_pruned = 0
+            self.revisits_pruned = 0
+            reuse_key = self.__get_reuse_key()
+            previous_tree = None
+            # remote subtrees are not kept, so a parallel tree cannot be reused;
+            # neither can a sampled one, its rewards belong to the last draws
+            if self.reuse_tree and self.n_workers <= 1 and not self.branch_factor and \
+                    reuse_key is not None and self.evaluated_at == (t - 1, reuse_key):
+                # one move later every depth sees the specials of the next depth
+                specials = self.specials[1:] + predict_specials(self.state_posterior,
+                                                                [t + self.horizon + self.leaf_depth + 1],
+                                                                self.loss_penalty)
+                previous_tree = self.lookahead_tree
+            elif self.branch_factor:
+                specials = self.__sample_specials(t)
+            else:
+                specials = predict_specials(self.state_posterior,
+                                            range(t - 1, t + self.horizon + self.leaf_depth + 2), self.loss_penalty)
+            self.specials = specials
+            self.evaluated_at = (t, reuse_key)
+            if self.streaming:
+                lookahead_tree = self.__stream_tree(specials)
+                self.depth_reached = lookahead_tree.get_tree_depth()
+                self.nodes_expanded = lookahead_tree.get_tree_size()
+            elif self.array_tree:
+                lookahead_tree = ArraySparseTree(self.root_state)
+                grown_at = self.__grow_array_tree(lookahead_tree, specials, previous_tree, start_time)
+                self.__eval_array_tree(lookahead_tree)
+                if grown_at is not None:
+                    self.backup_time = (time.time() - grown_at) / lookahead_tree.size
+                self.depth_reached = len(lookahead_tree.levels)
+                self.nodes_expanded = lookahead_tree.get_tree_size()
+            else:
+                root_node = SparseTree.Node(NodeType.Decision, 0, self.root_state, [])
+                lookahead_tree = SparseTree(root_node, None)
+                self.__grow_sparse_tree(lookahead_tree, specials)
+                self.__eval_sparse_tree(lookahead_tree, specials)
             self.lookahead_tree = lookahead_tree
 
         def __str__(self):
@@ -115,60 +364,608 @@ class SparseTreeEvaluator(object):
             children_str += "}"
             return str(self.lookahead_tree.node) + " -> " + children_str
 
-        def __predict_specials(self, specials, time):
-            x_preds, y_preds = self.state_posterior.predict(time)
-            for x in x_preds[0]:
-                for y in y_preds[0]:
-                    specials.append((int(round(x[0])), int(round(y[0])), "red", self.loss_penalty, "NA"))
+        def __get_reuse_key(self):
+            # a tree can only be reused while the posterior, walls and goal are unchanged
+            version = getattr(self.state_posterior, "version", None)
+            if version is None:
+                return None
+            return (version, tuple(self.state_posterior.get_static_states()), tuple(self.goal_state),
+                    self.goal_reward, self.loss_penalty, self.horizon, tuple(self.action_set))
+
+        def __sample_specials(self, t):
+            # all times and configurations in one posterior draw; samples[i][k] is
+            # the k-th configuration at time t + i - 1. the draws are shared by
+            # all nodes of a depth, they are not resampled per (node, action)
+            times = np.arange(t - 1, t + self.horizon + self.leaf_depth + 2)
+            x_samples, y_samples = self.state_posterior.sample(times, self.branch_factor)
+            samples = []
+            for i in range(len(times)):
+                samples.append([{(int(round(x[i, k])), int(round(y[i, k])), "red", self.loss_penalty, "NA")
+                                 for x in x_samples for y in y_samples}
+                                for k in range(self.branch_factor)])
+            return samples
+
+        def __get_level_configs(self, specials, depth):
+            # one specials list per configuration an outcome averages over
+            if not self.branch_factor:
+                return [get_level_specials(specials, depth, self.goal_state, self.goal_reward)]
+            goal = (self.goal_state[0], self.goal_state[1], "green", self.goal_reward, "NA")
+            return [list(specials[depth][k] | specials[depth + 1][k] | specials[depth + 2][k]) + [goal]
+                    for k in range(self.branch_factor)]
 
         def __grow_sparse_tree(self, lookahead_tree, specials):
-            if (lookahead_tree.node.depth >= self.horizon) and (lookahead_tree.node.type == NodeType.Decision):
-                # leaves of sparse tree should be outcome nodes
-                return
+            # grown one depth level at a time, all (node, action) pairs on the
+            # frontier are simulated with a single sim_batch call
+            statics = self.state_posterior.get_static_states()
+            frontier = [lookahead_tree]
+            while frontier:
+                depth = frontier[0].node.depth
+                if depth >= self.horizon:
+                    # leaves of sparse tree should be outcome nodes
+                    if self.leaf_evaluator is not None:
+                        values = self.__get_leaf_values([node.node.state for node in frontier], statics,
+                                                        self.__get_leaf_configs(specials, depth))
+                        for node, value in zip(frontier, values.tolist()):
+                            node.node.value = [value]
+                    return
+                specials_t = get_level_specials(specials, depth, self.goal_state, self.goal_reward)
+                if depth == 0:
+                    filtered_specials, move_pools, transitions = self.__get_root_actions(lookahead_tree,
+                                                                                         specials_t, statics)
+                    # root keeps the (possibly thompson sampled) move pool
+                    lookahead_tree.actions = move_pools[0]
+                else:
+                    filtered_specials = specials_t
+                    move_pools = [self.action_set] * len(frontier)
 
-            if lookahead_tree.node.type == NodeType.Decision:
-                specials_t = list(set(specials[lookahead_tree.node.depth]) |
-                                  set(specials[lookahead_tree.node.depth + 1]) |
-                                  set(specials[lookahead_tree.node.depth + 2]))
-                specials_t.append((
-                                    self.goal_state[0], self.goal_state[1], "green",
-                                self.goal_reward, "NA"))
-                statics = self.state_posterior.get_static_states()
-                # if we are at root node, and asked to evaluate decision tree
-                # we assume that special and tree root cannot overlap
-                # otherwise, there is no tree to construct
-                filtered_specials = specials_t.copy()
-                if lookahead_tree.node.depth == 0:
-                    for idx, (i, j, c, r, v) in enumerate(specials_t):
-                        if lookahead_tree.node.state[0] == i and lookahead_tree.node.state[1] == j:
-                            print("Root at special", (i, j, c, r, v))
-                            if not c == "green":
-                                self.ignored_specials.append([i, j])
-                                filtered_specials.pop(idx)
-                if lookahead_tree.node.depth == 0 and self.thompson_sampler:
-                    move_pool = self.__get_actions(lookahead_tree, filtered_specials, statics, True)
-                    lookahead_tree.actions = move_pool
+                states = [node.node.state for node, pool in zip(frontier, move_pools) for _ in pool]
+                actions = [action for pool in move_pools for action in pool]
+                if not actions:
+                    return
+                if depth == 0:
+                    # the root moves were simulated when its pool was expanded
+                    rewards = np.array([reward for reward, _ in transitions], dtype=float)
+                    child_states = np.array([child_state for _, child_state in transitions], dtype=int)
+                else:
+                    rewards, child_states, _ = self.simulator.sim_batch(states, actions,
+                                                                        specials=filtered_specials,
+                                                                        walls=statics)
+                if self.close_terminals:
+                    closed = self.__in_cells(child_states, filtered_specials)
+                    rewards = np.where(closed, rewards * self.__get_terminal_scale(depth), rewards)
+                    closed = closed.tolist()
+                else:
+                    closed = [False] * len(actions)
+                rewards = rewards.tolist()
+                child_states = child_states.tolist()
+
+                next_frontier = []
+                idx = 0
+                for node, pool in zip(frontier, move_pools):
+                    valid_actions = []
+                    path = self.__get_path(node) if self.cycle_pruning and depth else []
+                    for action in pool:
+                        child_reward, child_state, terminal = rewards[idx], tuple(child_states[idx]), closed[idx]
+                        idx += 1
+                        if list(child_state) == list(node.node.state):
+                            continue
+                        if list(child_state) in path:
+                            if list(child_state) == path[0]:
+                                self.backtracks_pruned += 1
+                            else:
+                                self.revisits_pruned += 1
+                            continue
+                        valid_actions.append(action)
+                        child = SparseTree(SparseTree.Node(NodeType.Outcome, depth,
+                                                           child_state, [child_reward]), node)
+                        node.add_child(child)
+                        if print_debug: print("Added outcome child depth", child)
+                        if terminal:
+                            child.terminal = True
+                            continue
+                        grandchild = SparseTree(SparseTree.Node(NodeType.Decision, depth + 1,
+                                                                child_state, []), child)
+                        child.add_child(grandchild)
+                        next_frontier.append(grandchild)
+                    if depth:
+                        node.actions = valid_actions
+                frontier = next_frontier
+
+        def __get_path(self, node):
+            # cells of the decisions above node, latest first
+            path = []
+            ancestor = node.parent
+            while ancestor is not None:
+                if ancestor.node.type == NodeType.Decision:
+                    path.append(list(ancestor.node.state))
+                ancestor = ancestor.parent
+            return path
+
+        def __grow_array_tree(self, lookahead_tree, specials, previous_tree=None, start_time=None):
+            # same expansion as __grow_sparse_tree, written straight into the
+            # node arrays: one sim_batch call and a handful of array ops per level.
+            # levels already grown in previous_tree (the tree of the previous
+            # move) are copied instead of simulated.
+            # a tree grown to depth d is the horizon d tree, except that closed
+            # terminals (close_terminals) keep their value up to the full horizon;
+            # stopping between levels (anytime mode) leaves a valid tree.
+            # returns the time growing ended, before the leaf values
+            statics = self.state_posterior.get_static_states()
+            frontier = np.zeros(1, dtype=np.int32)
+            previous_frontier = None
+            depth = 0
+            grow_start = time.time()
+            while len(frontier) and depth < self.horizon:
+                if self.n_workers > 1 and depth == self.split_depth:
+                    self.__grow_remote(lookahead_tree, frontier, depth, specials, statics)
+                    return None
+                if depth and not self.__within_budget(lookahead_tree, frontier, start_time, grow_start):
+                    break
+                if previous_frontier is not None and depth < len(previous_tree.levels) - 1:
+                    frontier, previous_frontier = self.__copy_array_level(lookahead_tree, frontier, depth,
+                                                                          previous_tree, previous_frontier)
                 else:
-                    move_pool = self.__get_actions(lookahead_tree, filtered_specials, statics, False)
-                    lookahead_tree.actions = move_pool
-                for action in move_pool:
-                    orig_state, child_action, child_reward, child_state, _ = \
-                        self.simulator.sim(lookahead_tree.node.state, action,
-                                           specials=filtered_specials, walls=statics)
-                    if list(child_state) == list(orig_state):
+                    out_of_time = None
+                    if depth and self.time_budget is not None:
+                        out_of_time = lambda pending: self.__out_of_time(lookahead_tree, start_time, pending)
+                    next_frontier = self.__expand_array_level(lookahead_tree, frontier, depth,
+                                                              self.__get_level_configs(specials, depth), statics,
+                                                              out_of_time)
+                    if next_frontier is None:
+                        # the level ran past the deadline and was dropped
+                        break
+                    frontier = next_frontier
+                    if depth == 0 and previous_tree is not None:
+                        previous_frontier = self.__match_previous_root(lookahead_tree, frontier, previous_tree)
+                depth += 1
+            grown_at = time.time()
+            if self.leaf_evaluator is not None and len(frontier):
+                lookahead_tree.value[frontier] = self.__get_leaf_values(lookahead_tree.state[frontier], statics,
+                                                                        self.__get_leaf_configs(specials, depth))
+            return grown_at
+
+        def __get_leaf_configs(self, specials, depth):
+            # specials configurations of the leaf evaluator's moves below depth
+            return [self.__get_level_configs(specials, d) for d in range(depth, depth + self.leaf_depth)]
+
+        def __get_leaf_values(self, states, statics, leaf_configs):
+            return self.leaf_evaluator.evaluate(states, statics, self.goal_state, self.goal_reward,
+                                                self.discount_factor, specials=leaf_configs)
+
+        def __within_budget(self, lookahead_tree, frontier, start_time, grow_start):
+            # a level adds at most one outcome and one decision per (node, action)
+            next_nodes = 2 * len(frontier) * len(self.action_set)
+            if self.node_budget is not None and lookahead_tree.size + next_nodes > self.node_budget:
+                return False
+            if self.time_budget is not None:
+                # projected from the time spent growing per node so far; elapsed
+                # includes predicting the specials
+                now = time.time()
+                per_node = (now - grow_start) / lookahead_tree.size
+                if now - start_time + (per_node + self.backup_time) * next_nodes + \
+                        self.backup_time * lookahead_tree.size > self.time_budget:
+                    return False
+            return True
+
+        def __out_of_time(self, lookahead_tree, start_time, pending):
+            # past the deadline once the leaf values and backup of the tree,
+            # with pending more nodes, are accounted for
+            backup = self.backup_time * (lookahead_tree.size + pending)
+            return time.time() - start_time + backup > self.time_budget
+
+        def __stream_tree(self, specials):
+            # depth first grow and evaluate with an explicit stack of decision
+            # frames [rewards, weights, child_states, next_child, values, bounds];
+            # the frame at stack[d] is the decision node at depth d
+            statics = self.state_posterior.get_static_states()
+            level_configs = [self.__get_level_configs(specials, depth)
+                             for depth in range(self.horizon + self.leaf_depth)]
+            self.nodes_pruned = 0
+            if self.pruning:
+                self.value_bounds = self.__get_value_bounds()
+            root = StreamedSparseTree(SparseTree.Node(NodeType.Decision, 0, self.root_state, []))
+            stack = [self.__stream_frame(root, [self.root_state], 0, level_configs[0], statics)]
+            root.size += int(np.count_nonzero(stack[0][1]))
+            while True:
+                frame = stack[-1]
+                rewards, weights, child_states, idx, values, bounds = frame
+                if idx == len(rewards):
+                    if len(stack) == 1:
+                        break
+                    stack.pop()
+                    # decisions without children have no value
+                    child_value = max(values) if values else None
+                    parent = stack[-1]
+                    idx = parent[3]
+                else:
+                    # outcomes that cannot beat the best sibling are not expanded
+                    if bounds and values and bounds[idx] + 1e-9 * (1 + abs(max(values))) < max(values):
+                        self.nodes_pruned += 1
+                        frame[3] += 1
                         continue
-                    child = SparseTree(SparseTree.Node(NodeType.Outcome, lookahead_tree.node.depth,
-                                                       child_state, [child_reward]), lookahead_tree)
-                    lookahead_tree.add_child(child)
-                    if print_debug: print("Added outcome child depth",  child)
-                    self.__grow_sparse_tree(child, specials)
+                    depth = len(stack)
+                    root.depth = max(root.depth, depth)
+                    if not frame[1][idx]:
+                        # closed terminal outcome
+                        child_value = None
+                        parent = frame
+                    elif depth < self.horizon - self.stream_block:
+                        child = self.__stream_frame(root, child_states[idx:idx + 1], depth,
+                                                    level_configs[depth], statics, self.__get_stack_path(stack))
+                        stack.append(child)
+                        root.size += 1 + int(np.count_nonzero(child[1]))
+                        continue
+                    else:
+                        # the rest of the subtree in one piece
+                        paths = [self.__get_stack_path(stack)] if self.cycle_pruning else None
+                        values, size, levels = self.evaluate_frontier(np.array(child_states[idx:idx + 1]), depth,
+                                                                      level_configs[depth:], statics, paths)
+                        root.size += size
+                        root.depth = max(root.depth, depth + levels)
+                        child_value = None if np.isnan(values[0]) else float(values[0])
+                        parent = frame
+                reward, weight = parent[0][idx], parent[1][idx]
+                if child_value is None:
+                    parent[4].append(reward * self.discount_factor)
+                else:
+                    parent[4].append((reward + weight * child_value) * self.discount_factor)
+                parent[3] += 1
 
-            if lookahead_tree.node.type == NodeType.Outcome:
-                child = SparseTree(SparseTree.Node(NodeType.Decision,
-                                                   lookahead_tree.node.depth + 1,
-                                                   lookahead_tree.node.state, []), lookahead_tree)
-                lookahead_tree.add_child(child)
-                self.__grow_sparse_tree(child, specials)
+            # root value is (best_action_indexes, max_value, [action_values])
+            rewards, weights, child_states, idx, root_values, bounds = stack[0]
+            for state, value in zip(child_states, root_values):
+                root.add_child(SparseTree(SparseTree.Node(NodeType.Outcome, 0, tuple(state), [value]), root))
+            if not root_values:
+                print(root.node.state)
+                print(root.actions)
+            max_value = max(root_values)
+            max_idxs = [i for i, j in enumerate(root_values) if j == max_value]
+            root.node.value = (max_idxs, max_value, [root_values])
+            return root
+
+        def __get_stack_path(self, stack):
+            # cells of the decisions on the stack, latest first
+            return [frame[2][frame[3]] for frame in reversed(stack[:-1])] + [list(self.root_state)]
+
+        def __stream_frame(self, root, state, depth, configs, statics, path=None):
+            if depth == 0:
+                configs, pool = self.__get_root_configs(root, configs, statics)
+            else:
+                pool = list(range(len(self.action_set)))
+            if not pool:
+                return [[], [], [], 0, [], None]
+            states = np.repeat(np.asarray(state).reshape(1, 2), len(pool), axis=0)
+            rewards, weights, moved, child_states = self.__simulate_configs(states, np.array(pool),
+                                                                            configs, statics, depth)
+            if self.cycle_pruning and depth:
+                backtrack = moved & self.__in_cells(child_states, path[:1])
+                revisit = moved & self.__in_cells(child_states, path) & ~backtrack
+                self.backtracks_pruned += int(np.count_nonzero(backtrack))
+                self.revisits_pruned += int(np.count_nonzero(revisit))
+                moved &= ~(backtrack | revisit)
+            rewards, weights, child_states = rewards[moved], weights[moved], child_states[moved]
+            if not self.pruning or depth == 0:
+                # root action values are all reported, so the root is never pruned
+                return [rewards.tolist(), weights.tolist(), child_states.tolist(), 0, [], None]
+            # a decision only keeps its max, so children are visited best bound first
+            distances = np.abs(child_states - np.asarray(self.goal_state)).sum(axis=1)
+            levels = self.horizon - depth - 1
+            bounds = (rewards + weights * np.asarray(self.value_bounds[levels])[np.minimum(distances, levels + 1)]) * \
+                     self.discount_factor
+            order = np.argsort(-bounds, kind="stable")
+            return [rewards[order].tolist(), weights[order].tolist(), child_states[order].tolist(), 0, [],
+                    bounds[order].tolist()]
+
+        def __get_value_bounds(self):
+            # value_bounds[l][m]: upper bound on a decision with l outcome levels left
+            # and m steps (manhattan) from the goal, the last entry is for m > l.
+            # any step but the one onto the goal earns at most the walk reward
+            # (at most 0 when averaging over sampled configurations)
+            step = 0.0 if self.branch_factor else getattr(self.simulator, "walk_reward", 0.0)
+            gamma = self.discount_factor
+
+            def reach_goal(levels, n):
+                # a closed goal outcome also holds the goal reward of the levels below it
+                stay = sum(gamma ** k for k in range(levels - n + 1)) if self.close_terminals and n <= levels else 1.0
+                return sum(gamma ** k * step for k in range(1, n)) + gamma ** n * self.goal_reward * stay
+
+            value_bounds = []
+            for levels in range(self.horizon + 1):
+                no_goal = sum(gamma ** k * max(step, 0.0) for k in range(1, levels + 1))
+                # a leaf estimate can reach the goal one move past the leaves at
+                # the earliest (later is worth less, walk rewards being negative)
+                deepest = levels + 1 if self.leaf_evaluator is not None else levels
+                row = []
+                for m in range(levels + 1):
+                    goal = max(reach_goal(levels, n) for n in range(max(m, 1), deepest + 1)) if deepest else no_goal
+                    row.append(max(no_goal, goal))
+                beyond = max(no_goal, reach_goal(levels, deepest)) if deepest > levels else no_goal
+                value_bounds.append(row + [beyond])
+            return value_bounds
+
+        def __get_root_configs(self, lookahead_tree, configs, statics):
+            # root move pool (as action indexes), and the configs without the
+            # non goal specials the root stands on
+            specials_t = configs[0] if len(configs) == 1 else list(set().union(*configs))
+            filtered_specials, move_pools, _ = self.__get_root_actions(lookahead_tree, specials_t, statics)
+            lookahead_tree.actions = move_pools[0]
+            pool = [self.action_set.index(action) for action in move_pools[0]]
+            if len(configs) == 1:
+                return [filtered_specials], pool
+            x, y = lookahead_tree.node.state[0], lookahead_tree.node.state[1]
+            return [[s for s in config if not (s[0] == x and s[1] == y and s[2] != "green")]
+                    for config in configs], pool
+
+        def __simulate_configs(self, states, actions, configs, statics, depth):
+            # mean reward, continuation weight, moved mask and child state of
+            # every (states[i], actions[i]) over the specials configurations.
+            # all rows see the same configurations (shared per depth), and the
+            # configurations collapse into one child: its reward is their mean,
+            # and its state is the move of the last configuration that moved
+            action_names = np.asarray(self.action_set)[actions]
+            moved = np.zeros((len(configs), len(states)), dtype=bool)
+            rewards = np.zeros((len(configs), len(states)))
+            open_ = moved
+            if self.close_terminals:
+                open_ = np.zeros((len(configs), len(states)), dtype=bool)
+                terminal_scale = self.__get_terminal_scale(depth)
+            for k, config in enumerate(configs):
+                config_rewards, config_states, _ = self.simulator.sim_batch(states, action_names,
+                                                                            specials=config, walls=statics)
+                moved[k] = np.any(config_states != states, axis=1)
+                rewards[k] = np.where(moved[k], config_rewards, 0.0)
+                if self.close_terminals:
+                    # a configuration that ends the game here adds its closed
+                    # value, and nothing to the continuation
+                    closed = moved[k] & self.__in_cells(config_states, config)
+                    rewards[k] = np.where(closed, rewards[k] * terminal_scale, rewards[k])
+                    open_[k] = moved[k] & ~closed
+                child_states = config_states if not k else np.where(moved[k][:, np.newaxis],
+                                                                     config_states, child_states)
+            # actions that leave the state unchanged are not expanded; a
+            # configuration where the parent stands on a special ended the game
+            # before this move and adds nothing to the average
+            weights = np.mean(open_, axis=0)
+            rewards = np.sum(rewards, axis=0) / len(configs)
+            return rewards, weights, np.any(moved, axis=0), child_states
+
+        def __simulate_level(self, lookahead_tree, parents, states, actions, configs, statics, depth):
+            rewards, weights, moved, child_states = self.__simulate_configs(states, actions, configs,
+                                                                            statics, depth)
+            if self.cycle_pruning and depth:
+                moved &= ~self.__prune_cycles(lookahead_tree, parents, child_states, moved)
+            return rewards, weights, moved, child_states
+
+        def __prune_cycles(self, lookahead_tree, decisions, child_states, moved):
+            # the moves of decisions[i] onto a cell of its path, found by walking
+            # up the decision ancestors and then the root_paths above the roots
+            backtrack = np.zeros(len(decisions), dtype=bool)
+            revisit = np.zeros(len(decisions), dtype=bool)
+            node, top, steps = decisions, decisions, 0
+            while True:
+                outcome = np.where(node >= 0, lookahead_tree.parent[np.maximum(node, 0)], -1)
+                node = np.where(outcome >= 0, lookahead_tree.parent[np.maximum(outcome, 0)], -1)
+                if not np.any(node >= 0):
+                    break
+                top = np.where(node >= 0, node, top)
+                hit = (node >= 0) & np.all(lookahead_tree.state[np.maximum(node, 0)] == child_states, axis=1)
+                (revisit if steps else backtrack)[hit] = True
+                steps += 1
+            if lookahead_tree.root_paths is not None:
+                for root in np.unique(top[top < len(lookahead_tree.root_paths)]):
+                    rows = np.flatnonzero(top == root)
+                    path = lookahead_tree.root_paths[root]
+                    # the latest cell is the one just left only for the root itself
+                    latest = self.__in_cells(child_states[rows], path[:1]) & (decisions[rows] == root)
+                    backtrack[rows] |= latest
+                    revisit[rows] |= self.__in_cells(child_states[rows], path) & ~latest
+            backtrack &= moved
+            revisit &= moved & ~backtrack
+            self.backtracks_pruned += int(np.count_nonzero(backtrack))
+            self.revisits_pruned += int(np.count_nonzero(revisit))
+            return backtrack | revisit
+
+        def __in_cells(self, states, cells):
+            # states[i] is one of the cells (specials or [x, y] pairs)
+            cells = np.array([(c[0], c[1]) for c in cells], dtype=int).reshape(-1, 2)
+            states = np.asarray(states).reshape(-1, 2)
+            return np.any(np.all(states[:, np.newaxis, :] == cells[np.newaxis, :, :], axis=2), axis=1)
+
+        def __get_terminal_scale(self, depth):
+            # the agent stays frozen on the special and World.try_move pays its
+            # reward again every move, one more per level left below depth
+            return sum(self.discount_factor ** k for k in range(self.horizon - depth))
+
+        def __expand_array_level(self, lookahead_tree, frontier, depth, configs, statics, out_of_time=None):
+            # configs holds one specials list per sampled configuration, or just
+            # the posterior mean one when branch_factor is not set.
+            # with out_of_time the level is simulated in chunks of BUDGET_CHUNK
+            # (node, action) pairs; past the deadline the level is dropped before
+            # any of its nodes are added, and None is returned
+            if depth == 0:
+                configs, pool = self.__get_root_configs(lookahead_tree, configs, statics)
+            else:
+                pool = list(range(len(self.action_set)))
+            if not pool:
+                return np.zeros(0, dtype=np.int32)
+
+            slots = np.repeat(np.arange(len(frontier)), len(pool))
+            parents = frontier[slots]
+            actions = np.tile(pool, len(frontier))
+            states = lookahead_tree.state[parents]
+            if out_of_time is None:
+                rewards, weights, moved, child_states = self.__simulate_level(lookahead_tree, parents, states,
+                                                                              actions, configs, statics, depth)
+            else:
+                chunks = []
+                for start in range(0, len(parents), BUDGET_CHUNK):
+                    rows = slice(start, start + BUDGET_CHUNK)
+                    chunks.append(self.__simulate_level(lookahead_tree, parents[rows], states[rows],
+                                                        actions[rows], configs, statics, depth))
+                    if out_of_time(2 * (start + BUDGET_CHUNK)):
+                        return None
+                rewards, weights, moved, child_states = [np.concatenate(part) for part in zip(*chunks)]
+            n_children = int(np.count_nonzero(moved))
+            child_states = child_states[moved]
+
+            outcome_start = lookahead_tree.add_nodes(NodeType.Outcome, depth, child_states, parents[moved],
+                                                     rewards=rewards[moved], actions=actions[moved],
+                                                     weights=weights[moved])
+            counts = np.bincount(slots[moved], minlength=len(frontier))
+            lookahead_tree.child_count[frontier] = counts
+            lookahead_tree.child_start[frontier] = outcome_start + np.cumsum(counts) - counts
+            outcomes = np.arange(outcome_start, outcome_start + n_children, dtype=np.int32)
+            # closed terminal outcomes get no decision child
+            open_ = weights[moved] > 0
+            outcomes, child_states = outcomes[open_], child_states[open_]
+
+            if self.transpositions:
+                # specials only depend on depth, so one decision node per
+                # distinct child state is enough; its parent is the first outcome
+                child_states, first, shared = np.unique(child_states, axis=0,
+                                                        return_index=True, return_inverse=True)
+                decision_parents = outcomes[first]
+                shared = shared.reshape(-1)
+            else:
+                decision_parents = outcomes
+                shared = np.arange(len(outcomes))
+            decision_start = lookahead_tree.add_nodes(NodeType.Decision, depth + 1, child_states,
+                                                      decision_parents)
+            lookahead_tree.child_count[outcomes] = 1
+            lookahead_tree.child_start[outcomes] = decision_start + shared
+            lookahead_tree.levels.append((int(frontier[0]), int(frontier[-1]) + 1,
+                                          outcome_start, outcome_start + n_children))
+            return np.arange(decision_start, decision_start + len(child_states), dtype=np.int32)
+
+        def __grow_remote(self, lookahead_tree, frontier, depth, specials, statics):
+            # the frontier decisions are split across the pool; workers only
+            # send back the values of the decisions they were given
+            level_specials = [self.__get_level_configs(specials, d)
+                              for d in range(depth, self.horizon + self.leaf_depth)]
+            chunks = np.array_split(frontier, min(len(frontier), self.n_workers))
+            tasks = [(self.goal_state, self.goal_reward, (lookahead_tree.state[chunk], depth, level_specials, statics))
+                     for chunk in chunks]
+            for chunk, (values, size, levels) in zip(chunks, self.__get_pool().map(_evaluate_frontier, tasks)):
+                lookahead_tree.value[chunk] = values
+                lookahead_tree.remote_nodes += size - len(chunk)
+
+        def __get_pool(self):
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.n_workers, initializer=_init_worker,
+                                                 initargs=(self.simulator, self.action_set, self.horizon,
+                                                           self.discount_factor, self.transpositions,
+                                                           self.close_terminals, self.leaf_evaluator))
+            return self.pool
+
+        def close(self):
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+
+        def evaluate_frontier(self, states, depth, level_specials, statics, paths=None):
+            """ Values of the decision nodes (states[i], depth), the size of their subtrees and the
+                number of levels grown; level_specials[k] are the specials configurations at depth + k,
+                down to leaf_depth moves past the horizon
+                and paths[i] the cells above states[i], latest first (for cycle pruning) """
+            lookahead_tree = ArraySparseTree(states[0])
+            lookahead_tree.root_paths = paths
+            lookahead_tree.add_nodes(NodeType.Decision, depth, states[1:], np.full(len(states) - 1, -1))
+            lookahead_tree.depth[0] = depth
+            frontier = np.arange(len(states), dtype=np.int32)
+            for level in range(depth, self.horizon):
+                if not len(frontier):
+                    break
+                frontier = self.__expand_array_level(lookahead_tree, frontier, level,
+                                                     level_specials[level - depth], statics)
+            if self.leaf_evaluator is not None and len(frontier):
+                lookahead_tree.value[frontier] = self.__get_leaf_values(lookahead_tree.state[frontier], statics,
+                                                                        level_specials[len(lookahead_tree.levels):])
+            self.__eval_array_levels(lookahead_tree)
+            return lookahead_tree.value[:len(states)].copy(), lookahead_tree.get_tree_size(), \
+                   len(lookahead_tree.levels)
+
+        def __match_previous_root(self, lookahead_tree, frontier, previous_tree):
+            # the new root must be one of the previous root's outcomes, and each
+            # new depth 1 decision one of that outcome's grandchildren
+            start, count = previous_tree.child_start[0], previous_tree.child_count[0]
+            root_outcomes = np.arange(start, start + count)
+            hits = np.flatnonzero(np.all(previous_tree.state[root_outcomes] == lookahead_tree.state[0], axis=1))
+            if not len(hits):
+                return None
+            previous_root = previous_tree.child_start[root_outcomes[hits[0]]]
+            start, count = previous_tree.child_start[previous_root], previous_tree.child_count[previous_root]
+            previous_decisions = {tuple(previous_tree.state[i].tolist()): previous_tree.child_start[i]
+                                  for i in range(start, start + count)}
+            matched = [previous_decisions.get(tuple(state)) for state in lookahead_tree.state[frontier].tolist()]
+            if None in matched:
+                return None
+            return np.array(matched, dtype=np.int32)
+
+        def __copy_array_level(self, lookahead_tree, frontier, depth, previous_tree, previous_frontier):
+            # frontier[i] is grown exactly like previous_frontier[i] (one level
+            # deeper in previous_tree), so its outcomes and their decisions are copied
+            counts = previous_tree.child_count[previous_frontier]
+            n_children = int(counts.sum())
+            offsets = np.cumsum(counts) - counts
+            previous_outcomes = np.repeat(previous_tree.child_start[previous_frontier] - offsets, counts) + \
+                                np.arange(n_children)
+            slots = np.repeat(np.arange(len(frontier)), counts)
+
+            outcome_start = lookahead_tree.add_nodes(NodeType.Outcome, depth,
+                                                     previous_tree.state[previous_outcomes], frontier[slots],
+                                                     rewards=previous_tree.reward[previous_outcomes],
+                                                     actions=previous_tree.action[previous_outcomes],
+                                                     weights=previous_tree.weight[previous_outcomes])
+            lookahead_tree.child_count[frontier] = counts
+            lookahead_tree.child_start[frontier] = outcome_start + offsets
+            outcomes = np.arange(outcome_start, outcome_start + n_children, dtype=np.int32)
+
+            previous_decisions, first, shared = np.unique(previous_tree.child_start[previous_outcomes],
+                                                          return_index=True, return_inverse=True)
+            decision_start = lookahead_tree.add_nodes(NodeType.Decision, depth + 1,
+                                                      previous_tree.state[previous_decisions], outcomes[first])
+            lookahead_tree.child_count[outcomes] = 1
+            lookahead_tree.child_start[outcomes] = decision_start + shared.reshape(-1)
+            lookahead_tree.levels.append((int(frontier[0]), int(frontier[-1]) + 1,
+                                          outcome_start, outcome_start + n_children))
+            lookahead_tree.reused_nodes += n_children + len(previous_decisions)
+            return np.arange(decision_start, decision_start + len(previous_decisions), dtype=np.int32), \
+                   previous_decisions.astype(np.int32)
+
+        def __eval_array_tree(self, lookahead_tree):
+            self.__eval_array_levels(lookahead_tree)
+            # root value is (best_action_indexes, max_value, [action_values])
+            start, count = lookahead_tree.child_start[0], lookahead_tree.child_count[0]
+            root_values = lookahead_tree.value[start:start + count].tolist()
+            if not root_values:
+                print(lookahead_tree.node.state)
+                print(lookahead_tree.actions)
+            max_value = max(root_values)
+            max_idxs = [i for i, j in enumerate(root_values) if j == max_value]
+            lookahead_tree.node.value = (max_idxs, max_value, [root_values])
+
+        def __eval_array_levels(self, lookahead_tree):
+            # bottom-up over the levels; decisions without children hold NaN
+            # unless a worker already filled in their value
+            value = lookahead_tree.value
+            for decision_start, decision_end, outcome_start, outcome_end in reversed(lookahead_tree.levels):
+                child_values = value[lookahead_tree.child_start[outcome_start:outcome_end]]
+                closed = lookahead_tree.child_count[outcome_start:outcome_end] == 0
+                future = np.where(np.isnan(child_values) | closed, 0.0, child_values)
+                weights = lookahead_tree.weight[outcome_start:outcome_end]
+                value[outcome_start:outcome_end] = (lookahead_tree.reward[outcome_start:outcome_end] +
+                                                    weights * future) * self.discount_factor
+                counts = lookahead_tree.child_count[decision_start:decision_end]
+                expanded = np.flatnonzero(counts) + decision_start
+                if len(expanded):
+                    value[expanded] = np.maximum.reduceat(value[outcome_start:outcome_end],
+                                                          lookahead_tree.child_start[expanded] - outcome_start)
+
+        def __get_root_actions(self, lookahead_tree, specials_t, statics):
+            filtered_specials = filter_root_specials(lookahead_tree.node.state, specials_t, self.ignored_specials)
+            move_pool, transitions = self.__get_actions(lookahead_tree, filtered_specials, statics,
+                                                        self.thompson_sampler is not None)
+            return filtered_specials, [move_pool], [transitions[action] for action in move_pool]
 
         def __eval_sparse_tree(self, lookahead_tree, t):
             for child in lookahead_tree.children:
@@ -180,7 +977,7 @@ class SparseTreeEvaluator(object):
                     reward_avg = state_reward + (sum(lookahead_tree.node.value) / float(len(lookahead_tree.node.value)))
                 else:
                     reward_avg = state_reward
-                if len(lookahead_tree.children) == 0:
+                if len(lookahead_tree.children) == 0 and not lookahead_tree.terminal:
                     depth_factor = max(self.horizon, lookahead_tree.node.depth) - lookahead_tree.node.depth + 1
                     lookahead_tree.append_val_to_parent(reward_avg * float(depth_factor) * self.discount_factor)
                 else:
@@ -211,17 +1008,14 @@ class SparseTreeEvaluator(object):
                             lookahead_tree.append_val_to_parent(present_reward)
 
         def __get_actions(self, root, specials, statics, use_tsampler):
+            # valid moves and their <reward, new_state>, from a single expand
+            expansions = self.simulator.expand(root.node.state, specials, statics, self.action_set)
+            valid_actions = [action for action, _, _, _ in expansions]
+            transitions = {action: (reward, new_state) for action, reward, new_state, _ in expansions}
             if use_tsampler:
-                valid_actions = self.simulator.get_valid_actions(root.node.state,
-                                                                 self.action_set,
-                                                                 specials=specials,
-                                                                 walls=statics)
-                return self.thompson_sampler.get_action_set(valid_actions)
+                return self.thompson_sampler.get_action_set(valid_actions), transitions
             else:
-                return self.simulator.get_valid_actions(root.node.state,
-                                                                 self.action_set,
-                                                                 specials=specials,
-                                                                 walls=statics)
+                return valid_actions, transitions
 
         def __get_states(self, root, specials, statics):
             ## complete neighbor set
@@ -231,4 +1025,24 @@ class SparseTreeEvaluator(object):
                     self.simulator.sim(root.node.state, action,
                                        specials=specials, walls=statics)
                 neighbors.append(n_new_state)
-            return neighbors
\ No newline at end of file
+            return neighbors
+
+
+# pool workers keep one evaluator each, built from the parent's settings
+_worker_evaluator = None
+
+
+def _init_worker(simulator, action_set, horizon, discount_factor, transpositions, close_terminals, leaf_evaluator):
+    global _worker_evaluator
+    _worker_evaluator = SparseTreeEvaluator(simulator, None, action_set, horizon,
+                                            history_manager=None, state_posterior=None,
+                                            goal_state=None, goal_reward=None, loss_penalty=None,
+                                            discount_factor=discount_factor,
+                                            transpositions=transpositions, close_terminals=close_terminals,
+                                            leaf_evaluator=leaf_evaluator)
+
+
+def _evaluate_frontier(task):
+    # the goal moves between games, so it comes with every task
+    _worker_evaluator.goal_state, _worker_evaluator.goal_reward, frontier_task = task
+    return _worker_evaluator.evaluate_frontier(*frontier_task)
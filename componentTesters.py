@@ -9,7 +9,11 @@ from mdpSimulator import WorldSimulator
 from bayesSparse import SparseTreeEvaluator
 from historyManager import HistoryManager, BootstrapHistoryManager
 from thompsonSampling import ThompsonSampler
-from gpPosterior import GPPosterior
+from gpPosterior import GPPosterior, PeriodicSequence, classify_history
+from vectorWorld import VectorWorld
+from leafEvaluators import DistanceLeafEvaluator, RolloutLeafEvaluator
+from mctsPlanner import MCTSEvaluator
+from gridEngine import GridEngine, WallLayout
 from sklearn.gaussian_process.kernels import ExpSineSquared
 from matplotlib import pyplot as plt, colors
 import pickle
@@ -32,26 +36,306 @@ def test_world_simulator():
     print(w.sim([3, 2], "left")) # ([3, 0], 'right', 1.0, (4, 0))
 
 
-def sparse_tree_tester():
+def tester_posterior(history_manager, **posterior_args):
+    # GP posterior on history_manager with the testers' kernel; posterior_args
+    # are the GPPosterior mode flags (incremental, warm_start, periodic, ...)
+    kernel = ExpSineSquared(length_scale=2, periodicity=3.0,
+                            periodicity_bounds=(2, 10),
+                            length_scale_bounds=(1, 10))
+    return GPPosterior(history_manager=history_manager, kernel=kernel, log=None, **posterior_args)
+
+
+def random_play(history_manager, vector_world, n_moves):
+    # n_moves random moves in every game of vector_world, into history_manager
+    for i in range(n_moves):
+        actions = np.random.choice(history_manager.get_action_set(), vector_world.n_envs)
+        orig_states, rewards, new_states, times, dones = vector_world.step(actions)
+        history_manager.add_batch(orig_states, actions, rewards, new_states, times)
+
+
+def random_play_posterior(action_set, n_envs=64, n_moves=100):
+    # GP posterior fitted to n_envs games of random play on the default map
+    history_manager = HistoryManager(action_set)
+    gp = tester_posterior(history_manager)
+    random_play(history_manager, VectorWorld(n_envs, origin=(0, 3)), n_moves)
+    gp.update_posterior()
+    return history_manager, gp
+
+
+def fitted_observations_match(gp):
+    # every GP model of gp is fitted to exactly the observations of its class,
+    # repeated pairs included
+    for models, classes in ((gp.fitted_models_x, gp.x_obs), (gp.fitted_models_y, gp.y_obs)):
+        for model, dat in zip(models, classes):
+            fitted = sorted(zip(model.X_train_[:, 0].tolist(), model.y_train_.tolist()))
+            if not fitted == sorted(dat):
+                return False
+    return True
+
+
+def sparse_tree_tester(branch_factor=5, horizon=6):
+    # sparse sampling on a posterior fitted to random play
     t0 = time.time()
     simulator = WorldSimulator()
     root_state = [0, 4]
     action_set = ["up", "down", "left", "right"]
     print(simulator.get_valid_actions(root_state, action_set, specials=[], walls=[]))
 
-    simulator = WorldSimulator()
-    action_set = ["up", "down", "left", "right"]
-    horizon = 6
-    branch_factor = 5
-    history_manager = HistoryManager(action_set)
-    ste = SparseTreeEvaluator(simulator, root_state, action_set, history_manager, horizon)
-    ste.evaluate()
+    history_manager, gp = random_play_posterior(action_set)
+    ste = SparseTreeEvaluator(simulator, root_state, action_set, horizon,
+                              history_manager=history_manager,
+                              state_posterior=gp,
+                              goal_state=[9, 6],
+                              goal_reward=10,
+                              loss_penalty=-10,
+                              discount_factor=0.5,
+                              branch_factor=branch_factor)
+    ste.evaluate(0)
     print(ste)
     print(random.choice(ste.lookahead_tree.node.value[0]))
     t1 = time.time()
     print("Runtime:", t1-t0)
 
 
+def terminal_expansion_tester(horizon=6, branch_factor=None):
+    # node counts with and without closing off outcomes that land on a
+    # special, on the default static_specials map
+    simulator = WorldSimulator()
+    action_set = ["up", "down", "left", "right"]
+    history_manager, gp = random_play_posterior(action_set)
+    goal_state = list(terminal_state_win)
+    for root_state in [[0, 4], [2, 3], [6, 4], [8, 6]]:
+        sizes = []
+        for close_terminals in [False, True]:
+            t0 = time.time()
+            ste = SparseTreeEvaluator(simulator, root_state, action_set, horizon,
+                                      history_manager=history_manager,
+                                      state_posterior=gp,
+                                      goal_state=goal_state,
+                                      goal_reward=10,
+                                      loss_penalty=-10,
+                                      discount_factor=0.5,
+                                      array_tree=True,
+                                      branch_factor=branch_factor,
+                                      close_terminals=close_terminals)
+            ste.evaluate(0)
+            sizes.append(ste.lookahead_tree.get_tree_size())
+            print(root_state, "close_terminals" if close_terminals else "full horizon",
+                  "nodes:", sizes[-1], "values:", ste.lookahead_tree.node.value[2],
+                  "runtime: %.3f" % (time.time() - t0))
+        print("Nodes saved:", sizes[0] - sizes[1], "(%.1f%%)" % (100.0 * (sizes[0] - sizes[1]) / sizes[0]))
+
+
+def plan_move(simulator, history_manager, gp, root_state, horizon, **kwargs):
+    # best actions and action values of one array tree evaluation at time 0,
+    # towards the default map's goal, and its runtime
+    t0 = time.time()
+    ste = SparseTreeEvaluator(simulator, root_state, history_manager.action_set, horizon,
+                              history_manager=history_manager,
+                              state_posterior=gp,
+                              goal_state=list(terminal_state_win),
+                              goal_reward=10,
+                              loss_penalty=-10,
+                              discount_factor=0.5,
+                              array_tree=True,
+                              **kwargs)
+    ste.evaluate(0)
+    max_idxs, max_value, values = ste.lookahead_tree.node.value
+    best = [ste.lookahead_tree.actions[i] for i in max_idxs]
+    return best, dict(zip(ste.lookahead_tree.actions, values[0])), time.time() - t0
+
+
+def leaf_heuristic_tester(horizons=(4, 5), reference_horizon=10, branch_factor=None):
+    # short horizons with shortest path leaf values against a long horizon
+    # without them: agreement of the chosen actions and runtime per move
+    simulator = WorldSimulator()
+    action_set = ["up", "down", "left", "right"]
+    history_manager, gp = random_play_posterior(action_set)
+    leaf_evaluator = DistanceLeafEvaluator()
+    root_states = [[0, 3], [2, 3], [4, 1], [6, 4], [7, 1], [8, 3]]
+
+    reference = [plan_move(simulator, history_manager, gp, root_state, reference_horizon,
+                           branch_factor=branch_factor) for root_state in root_states]
+    print("Horizon", reference_horizon, "without leaf values: %.3fs per move" %
+          (sum(runtime for _, _, runtime in reference) / len(root_states)))
+    for horizon in horizons:
+        for leaf in [None, leaf_evaluator]:
+            agree, runtime = 0, 0.0
+            for root_state, (reference_best, _, _) in zip(root_states, reference):
+                best, _, elapsed = plan_move(simulator, history_manager, gp, root_state, horizon,
+                                             branch_factor=branch_factor, leaf_evaluator=leaf)
+                agree += bool(set(best) & set(reference_best))
+                runtime += elapsed
+            print("Horizon", horizon, "with" if leaf else "without", "leaf values:",
+                  agree, "/", len(root_states), "moves agree, %.3fs per move" % (runtime / len(root_states)))
+
+
+def rollout_benchmark(horizon=4, rollout_counts=(1, 4, 16), rollout_lengths=(2, 5, 10), policy="random",
+                      reference_horizon=10, branch_factor=None):
+    # decision quality against time per move of rollout leaf values: the
+    # regret of the chosen move under a long horizon tree without leaf values
+    simulator = WorldSimulator()
+    action_set = ["up", "down", "left", "right"]
+    history_manager, gp = random_play_posterior(action_set)
+    root_states = [[0, 3], [2, 3], [4, 1], [6, 4], [7, 1], [8, 3]]
+    reference = [plan_move(simulator, history_manager, gp, root_state, reference_horizon,
+                           branch_factor=branch_factor) for root_state in root_states]
+
+    def benchmark(name, leaf_evaluator):
+        regret, runtime = 0.0, 0.0
+        for root_state, (_, reference_values, _) in zip(root_states, reference):
+            best, _, elapsed = plan_move(simulator, history_manager, gp, root_state, horizon,
+                                         branch_factor=branch_factor, leaf_evaluator=leaf_evaluator)
+            regret += max(reference_values.values()) - np.mean([reference_values[a] for a in best])
+            runtime += elapsed
+        print(name, "mean regret: %.4f, %.4fs per move" % (regret / len(root_states), runtime / len(root_states)))
+
+    benchmark("No leaf values", None)
+    benchmark("Shortest path", DistanceLeafEvaluator())
+    for n_rollouts in rollout_counts:
+        for rollout_length in rollout_lengths:
+            benchmark("%d %s rollouts of %d moves" % (n_rollouts, policy, rollout_length),
+                      RolloutLeafEvaluator(simulator, n_rollouts=n_rollouts, rollout_length=rollout_length,
+                                           policy=policy))
+
+
+def mcts_benchmark(horizon=6, iteration_counts=(50, 200, 1000)):
+    # UCT search against the full sparse tree of the same horizon: regret of
+    # the chosen move, simulated transitions and runtime per move
+    simulator = WorldSimulator()
+    action_set = ["up", "down", "left", "right"]
+    history_manager, gp = random_play_posterior(action_set)
+    root_states = [[0, 3], [2, 3], [4, 1], [6, 4], [7, 1], [8, 3]]
+    reference = [plan_move(simulator, history_manager, gp, root_state, horizon) for root_state in root_states]
+    print("Sparse tree: %.4fs per move" % (sum(runtime for _, _, runtime in reference) / len(root_states)))
+    for n_iterations in iteration_counts:
+        regret, simulations, runtime = 0.0, 0, 0.0
+        for root_state, (_, reference_values, _) in zip(root_states, reference):
+            t0 = time.time()
+            mcts = MCTSEvaluator(simulator, root_state, action_set, horizon,
+                                 history_manager=history_manager,
+                                 state_posterior=gp,
+                                 goal_state=list(terminal_state_win),
+                                 goal_reward=10,
+                                 loss_penalty=-10,
+                                 discount_factor=0.5,
+                                 n_iterations=n_iterations)
+            mcts.evaluate(0)
+            runtime += time.time() - t0
+            best = [mcts.lookahead_tree.actions[i] for i in mcts.lookahead_tree.node.value[0]]
+            regret += max(reference_values.values()) - np.mean([reference_values[a] for a in best])
+            simulations += mcts.simulations
+        print(n_iterations, "iterations, mean regret: %.4f, %d transitions, %.4fs per move" %
+              (regret / len(root_states), simulations / len(root_states), runtime / len(root_states)))
+
+
+def gp_update_benchmark(n_games=20, n_envs=8, n_moves=30, reoptimize_every=5):
+    # update_posterior latency at every game boundary of a growing random play
+    # history, full refits against incremental updates
+    action_set = ["up", "down", "left", "right"]
+    history_manager = HistoryManager(action_set)
+    full_gp = tester_posterior(history_manager)
+    incremental_gp = tester_posterior(history_manager, incremental=True, reoptimize_every=reoptimize_every)
+    vector_world = VectorWorld(n_envs, origin=(0, 3))
+    print("game observations full(s) incremental(s) fitted")
+    for game in range(n_games):
+        random_play(history_manager, vector_world, n_moves)
+        t0 = time.time()
+        full_gp.update_posterior()
+        t1 = time.time()
+        incremental_gp.update_posterior()
+        t2 = time.time()
+        print(game, len(history_manager.get_history()), "%.4f %.4f" % (t1 - t0, t2 - t1),
+              "match" if fitted_observations_match(incremental_gp) else "MISMATCH")
+
+    # classify_history repeats the seed pair of every class; a penalty at an
+    # earlier time moves the seed, the class then holds the new seed pair twice
+    # and the old one once, which no append to the fitted model can give
+    seed_history = HistoryManager(action_set)
+    seed_gp = tester_posterior(seed_history, incremental=True, reoptimize_every=0)
+    for observations in ([(1, 1), (2, 2), (3, 3), (4, 2)], [(0, 2)]):
+        for t, value in observations:
+            seed_history.add(([value, value], "up", -10, [value, value], t))
+        seed_gp.update_posterior()
+    print("moved seed:", seed_gp.x_obs[0],
+          "match" if fitted_observations_match(seed_gp) else "MISMATCH")
+
+
+def gp_predict_benchmark(horizon=10, n_moves=100):
+    # the predictions of a game of planning (horizon + 3 times per move), from
+    # the prediction table against one sklearn predict per model and time
+    action_set = ["up", "down", "left", "right"]
+    history_manager, gp = random_play_posterior(action_set)
+    times = [t + i for t in range(n_moves) for i in range(-1, horizon + 2)]
+    t0 = time.time()
+    for t in times:
+        for gp_model in gp.fitted_models_x + gp.fitted_models_y:
+            gp_model.predict(np.array([[t]]), return_std=True)
+    t1 = time.time()
+    for t in times:
+        gp.predict_cells(t)
+    t2 = time.time()
+    print(len(times), "predictions,", len(gp.fitted_models_x) + len(gp.fitted_models_y), "models")
+    print("sklearn predict: %.4fs, prediction table (built once): %.4fs" % (t1 - t0, t2 - t1))
+
+
+def gp_periodic_tester(n_games=6, n_envs=16, n_moves=40):
+    # classes served by the exact periodicity lookup, and the update time
+    # against a posterior that fits a GP to every class
+    history_manager = HistoryManager(["up", "down", "left", "right"])
+    gp = tester_posterior(history_manager)
+    periodic_gp = tester_posterior(history_manager, periodic=True)
+    vector_world = VectorWorld(n_envs, origin=(0, 3))
+    for game in range(n_games):
+        random_play(history_manager, vector_world, n_moves)
+        gp.update_posterior()
+        periodic_gp.update_posterior()
+        models = [("period %d" % model.period) if isinstance(model, PeriodicSequence) else "gp"
+                  for model in periodic_gp.fitted_models_x + periodic_gp.fitted_models_y]
+        print(game, len(history_manager.get_history()), "observations, gp %.4fs, periodic %.4fs," %
+              (gp.update_time, periodic_gp.update_time), models)
+
+
+def classify_history_benchmark(sizes=(10 ** 4, 10 ** 5, 10 ** 6), episode_move_limit=100):
+    # classification of penalty observations drawn from the true red special
+    # trajectories of the default map, both coordinates as in update_posterior
+    simulator = WorldSimulator()
+    trajectory = simulator.get_specials_trajectory(world.static_specials, world.static_walls)
+    reds = [np.array([(s[0], s[1]) for s in trajectory.at(t) if s[2] == "red"])
+            for t in range(episode_move_limit)]
+    for size in sizes:
+        times = np.random.randint(0, episode_move_limit, size)
+        specials = np.random.randint(0, len(reds[0]), size)
+        cells = np.array([reds[t][s] for t, s in zip(times.tolist(), specials.tolist())])
+        t0 = time.time()
+        classes_x = classify_history(times, cells[:, 0])
+        classes_y = classify_history(times, cells[:, 1])
+        print(size, "observations: %.3fs," % (time.time() - t0), len(classes_x), "x classes,",
+              len(classes_y), "y classes")
+
+
+def gp_refit_benchmark(n_games=10, n_envs=8, n_moves=30, restart_patience=3, n_jobs=4):
+    # full re-optimization at every game boundary: cold serial restarts against
+    # warm started restarts with early exit, serial and on a thread pool
+    history_manager = HistoryManager(["up", "down", "left", "right"])
+    posteriors = [("cold", tester_posterior(history_manager)),
+                  ("warm", tester_posterior(history_manager, warm_start=True, restart_patience=restart_patience)),
+                  ("warm pool", tester_posterior(history_manager, warm_start=True,
+                                                 restart_patience=restart_patience, n_jobs=n_jobs))]
+    vector_world = VectorWorld(n_envs, origin=(0, 3))
+    for game in range(n_games):
+        random_play(history_manager, vector_world, n_moves)
+        print("game", game, len(history_manager.get_history()), "observations")
+        for name, gp in posteriors:
+            gp.update_posterior()
+            log_likelihood = sum(model.log_marginal_likelihood_value_
+                                 for model in gp.fitted_models_x + gp.fitted_models_y)
+            print("  %-9s %.4fs, %d optimizer runs, log likelihood %.2f" %
+                  (name, gp.update_time, sum(timing[3] for timing in gp.fit_timings), log_likelihood))
+            for axis, i, n_obs, runs, seconds in gp.fit_timings:
+                print("    %s%d: %d obs, %d runs, %.4fs" % (axis, i, n_obs, runs, seconds))
+
+
 def thompson_sampler_tester():
     action_set = ["up", "down", "left", "right"]
     branching_factor = 2
@@ -186,6 +470,63 @@ def gp_posterior_tester(log):
         pickle.dump(gp, output, pickle.HIGHEST_PROTOCOL)
 
 
+def vector_world_tester(n_envs=256, n_steps=400):
+    # random play in n_envs lockstep games, feeding one shared history and GP
+    history_manager = HistoryManager(["up", "down", "left", "right"])
+    gp = tester_posterior(history_manager)
+    vector_world = VectorWorld(n_envs, origin=(0, 3))
+    t0 = time.time()
+    random_play(history_manager, vector_world, n_steps)
+    t1 = time.time()
+    print("Played", vector_world.games_played, "games,", n_envs * n_steps, "moves in", t1 - t0, "s")
+    gp.update_posterior()
+    print("Posterior fit in", time.time() - t1, "s,", len(gp.fitted_models_x), "x models,",
+          len(gp.fitted_models_y), "y models")
+
+
+def grid_scaling_benchmark(sizes=(10, 100, 1000, 2000), special_counts=(10, 100, 1000, 5000),
+                           wall_density=0.02, n_steps=2000):
+    # per step cost against map size and number of moving specials:
+    # move_at only touches the wall bitmap and the cell -> specials index,
+    # step_at also builds the specials list, step re-simulates every special
+    action_set = ["up", "down", "left", "right"]
+    print("size specials build(s) move_at(us) step_at(us) step(us)")
+    for size in sizes:
+        engine = GridEngine(size, size)
+        n_walls = int(wall_density * size * size)
+        walls = WallLayout(sorted(set(zip(np.random.randint(0, size, n_walls).tolist(),
+                                          np.random.randint(0, size, n_walls).tolist()))))
+        for n_specials in special_counts:
+            specials = list(zip(np.random.randint(0, size, n_specials).tolist(),
+                                np.random.randint(0, size, n_specials).tolist(),
+                                ["red"] * n_specials, [-10] * n_specials,
+                                np.random.choice(action_set, n_specials).tolist()))
+            t0 = time.time()
+            trajectory = engine.get_trajectory(specials, walls)
+            build_time = time.time() - t0
+
+            moves = np.random.choice(action_set, n_steps).tolist()
+            state = (size // 2, size // 2)
+            t0 = time.time()
+            for t, move in enumerate(moves):
+                _, state, _ = engine.move_at(state, move, trajectory, t)
+            move_at_time = (time.time() - t0) / n_steps
+
+            n_list_steps = max(n_steps // 20, 1)
+            t0 = time.time()
+            for t, move in enumerate(moves[:n_list_steps]):
+                _, _, _, state, _ = engine.step_at(state, move, trajectory, n_steps + t)
+            step_at_time = (time.time() - t0) / n_list_steps
+
+            current = trajectory.at(2 * n_steps)
+            t0 = time.time()
+            for move in moves[:n_list_steps]:
+                _, _, _, state, current = engine.step(state, move, current, walls)
+            step_time = (time.time() - t0) / n_list_steps
+            print(size, n_specials, round(build_time, 3), round(move_at_time * 1e6, 1),
+                  round(step_at_time * 1e6, 1), round(step_time * 1e6, 1))
+
+
 def plot_gp(filename):
     gp = pickle.load(open(filename, "rb"))
     kernel = ExpSineSquared(length_scale=2, periodicity=3.0,
@@ -284,7 +625,7 @@ def sparse_tree_model_tester(arg_dict):
     root_path = arg_dict['root_path']
     simulator = WorldSimulator()
     true_specials = world.static_specials.copy()
-    true_walls = world.static_walls.copy()
+    true_walls = WallLayout(world.static_walls)
     total_move_count = 0
     game_move_count = 0
     episode_count = 0
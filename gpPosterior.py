@@ -1,13 +1,97 @@
+import time
+from collections import Counter
 import numpy as np
 import logger
+from concurrent.futures import ThreadPoolExecutor
+from scipy.linalg import cholesky, cho_solve, solve_triangular
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import WhiteKernel, ExpSineSquared
 import global_constants
+from gridEngine import WallLayout
+
+
+class PeriodicSequence(object):
+    """Stands in for the GaussianProcessRegressor of a class whose observations
+    repeat exactly with period: values[t mod period], with zero std"""
+
+    def __init__(self, period, values):
+        self.period = period
+        self.values = np.asarray(values, dtype=float)
+
+    def __lookup(self, times):
+        phases = np.rint(np.asarray(times, dtype=float)[:, 0]).astype(int) % self.period
+        return self.values[phases]
+
+    def predict(self, times, return_std=False):
+        preds = self.__lookup(times)
+        if return_std:
+            return preds, np.zeros(len(preds))
+        return preds
+
+    def sample_y(self, times, n_samples=1, random_state=None):
+        return np.repeat(self.__lookup(times)[:, np.newaxis], n_samples, axis=1)
+
+
+def classify_history(times, values, log=None):
+    """ Splits the <time, value> observations of one coordinate into one class per
+        special: as many classes as the most distinct values seen at one time, seeded
+        with the values of the narrowest such time. Values are then taken in ascending
+        order, each joining the class of lowest maximum that is not below it; a value
+        above every maximum joins the class at the position of the nearest maximum
+        in that order. Returns the lists of <time, value> of every class """
+    times = np.asarray(times, dtype=int)
+    values = np.asarray(values, dtype=int)
+    # distinct <time, value> pairs, sorted by time and then value
+    t_min, v_min = times.min(), values.min()
+    width = values.max() - v_min + 1
+    keys = np.unique((times - t_min) * width + (values - v_min))
+    pair_ts, pair_vs = keys // width + t_min, keys % width + v_min
+
+    # earliest of the narrowest times with the most distinct values
+    ts, starts, counts = np.unique(pair_ts, return_index=True, return_counts=True)
+    collisions = counts.max()
+    candidates = np.flatnonzero(counts == collisions)
+    ranges = pair_vs[starts[candidates] + collisions - 1] - pair_vs[starts[candidates]]
+    seed = candidates[np.argmin(ranges)]
+    seed_t = int(ts[seed])
+    maxima = pair_vs[starts[seed]:starts[seed] + collisions].tolist()
+    classes = [[(seed_t, value)] for value in maxima]
+
+    # only a value above every maximum raises one, so all observations of a
+    # value join the same class
+    distinct_values = np.unique(pair_vs)
+    assignment = np.empty(len(distinct_values), dtype=int)
+    for j, value in enumerate(distinct_values.tolist()):
+        order = sorted(range(len(maxima)), key=lambda k: maxima[k])
+        above = [k for k in order if value <= maxima[k]]
+        if above:
+            assignment[j] = above[0]
+            continue
+        assignment[j] = min(range(len(order)), key=lambda p: abs(maxima[order[p]] - value))
+        maxima[assignment[j]] = value
+        if len(maxima) > 1:
+            # whoops, rough classification
+            message = "Cannot cleanly classify: " + str(value) + ", classified to class " + str(assignment[j])
+            if log:
+                logger.log(message, logger=log)
+            else:
+                if global_constants.print_debug: print(message)
+
+    # each class gets its pairs by ascending value and then time, after its seed
+    order = np.lexsort((pair_ts, pair_vs))
+    pair_classes = assignment[np.searchsorted(distinct_values, pair_vs[order])]
+    order = order[np.argsort(pair_classes, kind="stable")]
+    bounds = np.cumsum(np.bincount(pair_classes, minlength=len(classes)))[:-1]
+    for c, members in enumerate(np.split(order, bounds)):
+        classes[c].extend(zip(pair_ts[members].tolist(), pair_vs[members].tolist()))
+    return classes
 
 
 class GPPosterior:
 
-    def __init__(self, history_manager, kernel=None, penalty_threshold=-1, log=None):
+    def __init__(self, history_manager, kernel=None, penalty_threshold=-1, log=None,
+                 incremental=False, reoptimize_every=10, warm_start=False, restart_patience=None,
+                 n_jobs=0, random_state=None, max_time=128, periodic=False, max_period=20):
         self.history_manager = history_manager
         self.fitted_models_x = []
         self.fitted_models_y = []
@@ -16,6 +100,37 @@ class GPPosterior:
         self.x_obs = []
         self.y_obs = []
         self.static_states = []
+        # WallLayout of static_states, rebuilt after a new static state is found
+        self.static_layout = None
+        # bumped whenever predictions or static states change
+        self.version = 0
+        # bumped whenever the fitted models change, the prediction table of
+        # every integer time in [-1, max_time] is rebuilt on the next predict
+        self.posterior_version = 0
+        self.max_time = max_time
+        self.table = None
+        self.table_version = None
+        # incremental updates append the new observations to the fitted models,
+        # the kernel hyperparameters are re-optimized every reoptimize_every
+        # updates (0 never re-optimizes after the first fit)
+        self.incremental = incremental
+        self.reoptimize_every = reoptimize_every
+        self.updates_since_optimize = None
+        # re-optimizations start from the previous optimum of each model, stop
+        # restarting a model after restart_patience restarts without improvement,
+        # and run the models and their restarts on a pool of n_jobs threads
+        self.warm_start = warm_start
+        self.restart_patience = restart_patience
+        self.n_jobs = n_jobs
+        self.random = np.random.RandomState(random_state)
+        # <axis, class, observations, optimizer runs, seconds> of every model
+        # of the last update, and the wall time of the whole update
+        self.fit_timings = []
+        self.update_time = None
+        # classes whose observations repeat exactly with a period up to
+        # max_period are served by a PeriodicSequence instead of a GP
+        self.periodic = periodic
+        self.max_period = max_period
         if not kernel:
             self.kernel = ExpSineSquared(length_scale=1, periodicity=1.0,
                                     periodicity_bounds=(2, 10),
@@ -23,13 +138,29 @@ class GPPosterior:
         else:
             self.kernel = kernel
 
+    def __setstate__(self, state):
+        # posteriors pickled before the incremental, warm start, periodic and
+        # prediction table options (main's testing_file) load with their defaults
+        defaults = {"static_layout": None, "version": 0, "posterior_version": 0, "max_time": 128,
+                    "table": None, "table_version": None, "incremental": False, "reoptimize_every": 10,
+                    "updates_since_optimize": None, "warm_start": False, "restart_patience": None,
+                    "n_jobs": 0, "random": np.random.RandomState(), "fit_timings": [], "update_time": None,
+                    "periodic": False, "max_period": 20}
+        defaults.update(state)
+        self.__dict__.update(defaults)
+
     def update_static_states(self, state):
         self.static_states.append(tuple(state))
+        self.static_layout = None
+        self.version += 1
 
     def get_static_states(self):
-        return self.static_states.copy()
+        if self.static_layout is None:
+            self.static_layout = WallLayout(self.static_states)
+        return self.static_layout
 
     def update_posterior(self, n_restarts=10, a=0.01):
+        start_time = time.time()
         # each history obs is <orig_state, action, reward, new_state, time>
         history = list(filter(lambda obs: obs[2] < self.penalty_threshold, self.history_manager.get_history()))
         if not len(history): return
@@ -39,122 +170,251 @@ class GPPosterior:
         self.x_obs = classified_x
         self.y_obs = classified_y
 
-        def fit_models(classified_dat, parent):
-            for dat in classified_dat:
+        reoptimize = not self.incremental or self.updates_since_optimize is None or \
+            bool(self.reoptimize_every and self.updates_since_optimize >= self.reoptimize_every)
+
+        self.fit_timings = []
+        fitted_models = {"x": [], "y": []}
+        optimize = []
+        for axis, classified_dat, previous_models in (("x", classified_x, self.fitted_models_x),
+                                                      ("y", classified_y, self.fitted_models_y)):
+            previous_models = self.__match_previous(classified_dat, previous_models)
+            for i, dat in enumerate(classified_dat):
                 t_obs = np.atleast_2d(list(map(lambda obs: obs[0], dat))).T
                 i_obs = np.array(list(map(lambda obs: obs[1], dat)))
+                fit_start = time.time()
+                periodic = self.__get_periodic(t_obs[:, 0], i_obs) if self.periodic else None
+                if periodic is not None:
+                    fitted_models[axis].append(periodic)
+                    self.fit_timings.append((axis, i, len(t_obs), 0, time.time() - fit_start))
+                    continue
+                previous = previous_models[i]
+                if reoptimize or previous is None:
+                    fitted_models[axis].append(None)
+                    optimize.append((axis, i, t_obs, i_obs, previous))
+                else:
+                    fitted_models[axis].append(self.__update_model(previous, t_obs, i_obs, a))
+                    self.fit_timings.append((axis, i, len(t_obs), 0, time.time() - fit_start))
+
+        for (axis, i, t_obs, _, _), (gp, runs, seconds) in zip(optimize,
+                                                               self.__optimize_models(optimize, n_restarts, a)):
+            fitted_models[axis][i] = gp
+            self.fit_timings.append((axis, i, len(t_obs), runs, seconds))
+
+        self.fitted_models_x = fitted_models["x"]
+        self.fitted_models_y = fitted_models["y"]
+        self.updates_since_optimize = 1 if reoptimize else self.updates_since_optimize + 1
+        self.version += 1
+        self.posterior_version += 1
+        self.update_time = time.time() - start_time
+
+    def __match_previous(self, classified_dat, previous_models):
+        # the previous GP of every class, or None: classify_history may
+        # re-partition the specials, so a class is matched to the model fitted
+        # mostly on its observations rather than to the model of the same index
+        fitted = [set(zip(model.X_train_[:, 0].tolist(), model.y_train_.tolist()))
+                  if isinstance(model, GaussianProcessRegressor) else set() for model in previous_models]
+        matches, taken = [], set()
+        for dat in classified_dat:
+            pairs = set(dat)
+            best, best_shared = None, 0
+            for k, model_pairs in enumerate(fitted):
+                shared = len(model_pairs & pairs)
+                if k not in taken and 2 * shared > len(model_pairs) and shared > best_shared:
+                    best, best_shared = k, shared
+            if best is not None:
+                taken.add(best)
+            matches.append(previous_models[best] if best is not None else None)
+        return matches
+
+    def __optimize_models(self, fits, n_restarts, a):
+        # <model, optimizer runs, seconds> of every <axis, class, t_obs, i_obs, previous model>
+        if not (self.warm_start or self.restart_patience or self.n_jobs):
+            results = []
+            for _, _, t_obs, i_obs, _ in fits:
+                fit_start = time.time()
                 gp = GaussianProcessRegressor(kernel=self.kernel,
                                               n_restarts_optimizer=n_restarts,
                                               alpha=a).fit(t_obs, i_obs)
-                parent.append(gp)
+                results.append((gp, n_restarts + 1, time.time() - fit_start))
+            return results
 
-        self.fitted_models_x = []
-        self.fitted_models_y = []
-        fit_models(classified_x, self.fitted_models_x)
-        fit_models(classified_y, self.fitted_models_y)
+        # the first run of a model starts from its previous optimum (or the
+        # initial kernel), restarts from hyperparameters drawn in the kernel bounds
+        kernels = [previous.kernel_ if self.warm_start and previous is not None else self.kernel
+                   for _, _, _, _, previous in fits]
+        bounds = self.kernel.bounds
+        if not len(bounds):
+            n_restarts = 0
+        thetas = [self.random.uniform(bounds[:, 0], bounds[:, 1], size=(n_restarts, len(bounds)))
+                  for _ in fits]
+        best = [None] * len(fits)
+        runs = [0] * len(fits)
+        seconds = [0.0] * len(fits)
+        stale = [0] * len(fits)
 
-    def __classify_history(self, history, new_state_idx):
-        hist_ts = set(map(lambda obs: obs[4], history))
-        hist_vals = set(map(lambda obs: obs[3][new_state_idx], history))
-
-        hist_dict = {key: list() for key in hist_ts}
-        for obs in history: hist_dict[obs[4]].append(obs[3][new_state_idx])
-
-        hist_dict_vals = {key: list() for key in hist_vals}
-        for obs in history: hist_dict_vals[obs[3][new_state_idx]].append(obs[4])
-
-        collisions = max(map(len, map(lambda x: set(x), hist_dict.values())))
-        classes = [list() for _ in range(collisions)]
-
-        def classify_obs(obs, t):
-            # trivial case, only 1 class
-            if len(classes) == 1:
-                classes[0].append((t, obs))
-                return
-
-            #last_class_vals = list(map(lambda lst: lst[len(lst) - 1] if lst else None, classes))
-            max_class_vals = [max(map(lambda val: val[1], c)) for c in classes]
-            sorted_max_class_vals = list(zip(sorted(range(len(max_class_vals)), key=lambda k: max_class_vals[k]),
-                                        sorted(max_class_vals)))
-            # first try to classify to one-off sequence
-            #for i, c in enumerate(classes):
-            #    for val in c:
-            #        if val and abs(val[0] - t) == 1 and abs(val[1] - obs) == 1:
-            #            classes[i].append((t, obs))
-            #            return
-
-            for sort_val in sorted_max_class_vals:
-                if obs <= sort_val[1]:
-                    classes[sort_val[0]].append((t, obs))
-                    return
-
-            # whoops, rough classification. Need to estimate
-            error_message = "Cannot cleanly classify: " + str((t,obs)) + " -> " + str(classes)
-            if self.log:
-                logger.log(error_message, logger=self.log)
-            else:
-                if global_constants.print_debug: print(error_message)
+        def run(job):
+            k, kernel = job
+            fit_start = time.time()
+            gp = GaussianProcessRegressor(kernel=kernel, alpha=a).fit(fits[k][2], fits[k][3])
+            return k, gp, time.time() - fit_start
 
-            # toss into next nearest neighbor, frobenius manhattan distance
-            min_coord_diff = min(sorted_max_class_vals, key=lambda x: abs(x[1] - obs))
-            classes[sorted_max_class_vals.index(min_coord_diff)].append((t, obs))
-
-            info_message = "Classified " + str(obs) + " to classes " + str(classes)
-            if self.log:
-                logger.log(info_message, logger=self.log)
-            else:
-                if global_constants.print_debug: print(info_message)
-
-        # initialize classes based on time with greatest collisions
-        coll_arr = []
-        for t in sorted(hist_dict.keys(), key=int):
-            t_obs = hist_dict[t]
-            if len(set(t_obs)) == collisions:
-                coll_arr.append((t, max(t_obs) - min(t_obs)))
-
-        if coll_arr:
-            coll_ranges = list(map(lambda val: val[1], coll_arr))
-            max_range_idx = coll_ranges.index(min(coll_ranges))
-            t_obs = hist_dict[coll_arr[max_range_idx][0]]
-            for i, o in enumerate(sorted(set(t_obs))):
-                classes[i].append((coll_arr[max_range_idx][0], o))
-            del hist_dict[coll_arr[max_range_idx][0]]
-
-        for val in sorted(hist_dict_vals.keys(), key=int):
-            unique_obs = set(hist_dict_vals[val])
-            if len(unique_obs) > 1:
-                # the set below doesnt duplicate data
-                for i, t in enumerate(sorted(set(hist_dict_vals[val]))):
-                    classify_obs(val, t)
-                    #classes[i].append((t, val))
-            else:
-                classify_obs(val, list(unique_obs)[0])
-
-        # validate classes
-        for i, c in enumerate(classes):
-            if not c:
-                classes.pop(i)
-                if self.log:
-                    logger.log("Expected more classes than classified!", logger=self.log)
-                    logger.log(str(history), logger=self.log)
+        def collect(results):
+            for k, gp, elapsed in results:
+                runs[k] += 1
+                seconds[k] += elapsed
+                if best[k] is None or gp.log_marginal_likelihood_value_ > best[k].log_marginal_likelihood_value_:
+                    improved = best[k] is None or \
+                        gp.log_marginal_likelihood_value_ - best[k].log_marginal_likelihood_value_ > 1e-6
+                    best[k] = gp
                 else:
-                    if global_constants.print_debug: print("Expected more classes than classified!", str(history))
+                    improved = False
+                stale[k] = 0 if improved else stale[k] + 1
+
+        pool = ThreadPoolExecutor(self.n_jobs) if self.n_jobs else None
+        run_all = pool.map if pool else map
+        try:
+            collect(run_all(run, list(enumerate(kernels))))
+            # restarts go in rounds that fill the pool, a model stops restarting
+            # once it has gone restart_patience restarts without improving
+            restart = [0] * len(fits)
+            while True:
+                active = [k for k in range(len(fits)) if restart[k] < n_restarts and
+                          not (self.restart_patience and stale[k] >= self.restart_patience)]
+                if not active:
+                    break
+                per_model = max(1, (self.n_jobs or 1) // len(active))
+                jobs = []
+                for k in active:
+                    for theta in thetas[k][restart[k]:restart[k] + per_model]:
+                        jobs.append((k, kernels[k].clone_with_theta(theta)))
+                    restart[k] = min(restart[k] + per_model, n_restarts)
+                collect(run_all(run, jobs))
+        finally:
+            if pool:
+                pool.shutdown()
+        return list(zip(best, runs, seconds))
 
-        return classes
+    def __get_periodic(self, t_obs, i_obs):
+        # the shortest period that every observation agrees with, once each of
+        # its phases has been observed at distinct times at least twice; None otherwise
+        t_obs = np.asarray(t_obs).astype(int)
+        times = np.unique(t_obs)
+        for period in range(1, min(self.max_period, len(times) // 2) + 1):
+            if np.bincount(times % period, minlength=period).min() < 2:
+                continue
+            phases = t_obs % period
+            values = np.full(period, np.nan)
+            values[phases] = i_obs
+            if np.array_equal(values[phases], i_obs):
+                return PeriodicSequence(period, values)
+        return None
+
+    def __update_model(self, gp, t_obs, i_obs, a):
+        # keeps the fitted kernel of gp; new observations of the class are
+        # appended to its cholesky factor, a class that lost observations to
+        # reclassification is refit with the kernel held fixed.
+        # observations are counted as a multiset, the history repeats pairs
+        fitted = Counter(zip(gp.X_train_[:, 0].tolist(), gp.y_train_.tolist()))
+        observed = list(zip(t_obs[:, 0].tolist(), i_obs.tolist()))
+        surplus = Counter(observed)
+        surplus.subtract(fitted)
+        if not gp.alpha == a or min(surplus.values()) < 0:
+            return GaussianProcessRegressor(kernel=gp.kernel_, optimizer=None, alpha=a).fit(t_obs, i_obs)
+        new_obs = []
+        for k, obs in enumerate(observed):
+            if surplus[obs] > 0:
+                surplus[obs] -= 1
+                new_obs.append(k)
+        if not new_obs:
+            return gp
+        t_new, i_new = t_obs[new_obs], i_obs[new_obs]
+        # [[K, B], [B', C]] = [[L, 0], [S', M]] [[L', S], [0, M']]
+        # with S = L^-1 B and M M' = C - S'S
+        cross = gp.kernel_(gp.X_train_, t_new)
+        block = gp.kernel_(t_new)
+        block[np.diag_indices_from(block)] += a
+        s = solve_triangular(gp.L_, cross, lower=True, check_finite=False)
+        m = cholesky(block - s.T @ s, lower=True, check_finite=False)
+        n = len(gp.X_train_)
+        L = np.zeros((n + len(new_obs), n + len(new_obs)))
+        L[:n, :n] = gp.L_
+        L[n:, :n] = s.T
+        L[n:, n:] = m
+        gp.X_train_ = np.vstack((gp.X_train_, t_new))
+        gp.y_train_ = np.concatenate((gp.y_train_, i_new))
+        gp.L_ = L
+        gp.alpha_ = cho_solve((L, True), gp.y_train_, check_finite=False)
+        gp.log_marginal_likelihood_value_ = -0.5 * gp.y_train_ @ gp.alpha_ - \
+            np.log(np.diag(L)).sum() - len(L) / 2 * np.log(2 * np.pi)
+        return gp
+
+    def __classify_history(self, history, new_state_idx):
+        times = np.fromiter((obs[4] for obs in history), dtype=int, count=len(history))
+        values = np.fromiter((obs[3][new_state_idx] for obs in history), dtype=int, count=len(history))
+        return classify_history(times, values, log=self.log)
 
     def predict(self, time):
+        table = self.__get_table(time)
+        if table is None:
+            return self.__predict_models(np.asarray(time, dtype=float).reshape(-1, 1))
+        i = int(time) + 1
+        x_preds, x_stds, y_preds, y_stds, _, _ = table
+        return (list(x_preds[:, i:i + 1]), list(x_stds[:, i:i + 1])), \
+               (list(y_preds[:, i:i + 1]), list(y_stds[:, i:i + 1]))
+
+    def predict_cells(self, time):
+        """ Rounded <x, y> cell of every pair of x and y models at time """
+        table = self.__get_table(time)
+        if table is None:
+            (x_preds, _), (y_preds, _) = self.predict(time)
+            x_cells = [int(round(x[0])) for x in x_preds]
+            y_cells = [int(round(y[0])) for y in y_preds]
+        else:
+            i = int(time) + 1
+            x_cells, y_cells = table[4][:, i].tolist(), table[5][:, i].tolist()
+        return [(x, y) for x in x_cells for y in y_cells]
+
+    def __get_table(self, time):
+        # <x_preds, x_stds, y_preds, y_stds, x_cells, y_cells>, (models, times)
+        # arrays starting one move before the game; None for a time off the
+        # integer grid, which is predicted directly
+        if np.ndim(time) or not float(time).is_integer() or time < -1:
+            return None
+        if time > self.max_time:
+            self.max_time = max(int(time), 2 * self.max_time)
+            self.table = None
+        if self.table is None or not self.table_version == self.posterior_version:
+            times = np.arange(-1, self.max_time + 1, dtype=float).reshape(-1, 1)
+            (x_preds, x_stds), (y_preds, y_stds) = self.__predict_models(times)
+            x_preds, x_stds, y_preds, y_stds = [np.array(preds, dtype=float).reshape(-1, len(times))
+                                                for preds in (x_preds, x_stds, y_preds, y_stds)]
+            self.table = (x_preds, x_stds, y_preds, y_stds,
+                          np.rint(x_preds).astype(int), np.rint(y_preds).astype(int))
+            self.table_version = self.posterior_version
+        return self.table
+
+    def __predict_models(self, times):
         x_preds = []
         x_stds = []
         for gp in self.fitted_models_x:
-            preds, stds = gp.predict(time, return_std=True)
+            preds, stds = gp.predict(times, return_std=True)
             x_preds.append(preds)
             x_stds.append(stds)
 
         y_preds = []
         y_stds = []
         for gp in self.fitted_models_y:
-            preds, stds = gp.predict(time, return_std=True)
+            preds, stds = gp.predict(times, return_std=True)
             y_preds.append(preds)
             y_stds.append(stds)
 
         return (x_preds, x_stds), (y_preds, y_stds)
+
+    def sample(self, times, n_samples, random_state=None):
+        # joint draws over all the times, one sample_y call per fitted model;
+        # each model gives a (len(times), n_samples) array
+        times = np.atleast_2d(times).T
+        x_samples = [gp.sample_y(times, n_samples, random_state=random_state) for gp in self.fitted_models_x]
+        y_samples = [gp.sample_y(times, n_samples, random_state=random_state) for gp in self.fitted_models_y]
+        return x_samples, y_samples
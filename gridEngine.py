@@ -0,0 +1,413 @@
+import numpy as np
+from functools import reduce
+from math import gcd
+
+
+class WallLayout(tuple):
+    """Immutable wall list whose hash is computed once. Owners of the walls
+    (world.World, GPPosterior) build one per wall version and pass it down,
+    so every cache keyed by walls is an O(1) lookup instead of rehashing the
+    whole wall list on each step."""
+
+    def __new__(cls, walls=()):
+        layout = tuple.__new__(cls, (tuple(wall) for wall in walls))
+        layout.hash = tuple.__hash__(layout)
+        return layout
+
+    def __hash__(self):
+        return self.hash
+
+    def __reduce__(self):
+        return WallLayout, (tuple(self),)
+
+
+class GridEngine(object):
+    """Headless, array backed grid dynamics. Mirrors world.World.try_move
+    without building a World (or any Tk state) per simulated transition."""
+
+    actions = ["up", "down", "left", "right"]
+    # (dx, dy) per action index, same order as world.World.actions
+    deltas = np.array([[0, -1], [0, 1], [-1, 0], [1, 0]])
+    # special colours and velocities are stored as integer codes
+    colour_codes = {"red": 0, "green": 1}
+    velocity_codes = {"up": 0, "down": 1, "left": 2, "right": 3}
+    velocity_names = ["up", "down", "left", "right"]
+
+    def __init__(self, x_dim, y_dim, walk_reward=-0.1, max_layouts=1024):
+        self.x_dim = x_dim
+        self.y_dim = y_dim
+        self.walk_reward = walk_reward
+        self.max_layouts = max_layouts
+        # walls key -> occupancy bitmap indexed [x, y]
+        self.wall_maps = dict()
+        # (specials key, walls key) -> (cell rewards, next specials, next cell rewards)
+        self.layouts = dict()
+        # (specials key, walls key) -> sorted cell ids and rewards for batched lookups
+        self.batch_layouts = dict()
+        # (specials key, walls key) -> SpecialsTrajectory
+        self.trajectories = dict()
+
+    def get_walls_key(self, walls):
+        # a WallLayout is its own (pre-hashed) key, other wall lists are hashed on every call
+        return walls if isinstance(walls, WallLayout) else tuple(walls)
+
+    def get_wall_map(self, walls):
+        key = self.get_walls_key(walls)
+        wall_map = self.wall_maps.get(key)
+        if wall_map is None:
+            if len(self.wall_maps) >= self.max_layouts:
+                self.wall_maps.clear()
+            wall_map = np.zeros((self.x_dim, self.y_dim), dtype=bool)
+            if walls:
+                wall_arr = np.array(walls, dtype=int).reshape(-1, 2)
+                in_bounds = (wall_arr[:, 0] >= 0) & (wall_arr[:, 0] < self.x_dim) & \
+                            (wall_arr[:, 1] >= 0) & (wall_arr[:, 1] < self.y_dim)
+                wall_map[wall_arr[in_bounds, 0], wall_arr[in_bounds, 1]] = True
+            self.wall_maps[key] = wall_map
+        return wall_map
+
+    def pack_specials(self, specials):
+        # (x, y, type, reward, velocity) tuples -> parallel arrays
+        n = len(specials)
+        xs = np.fromiter((s[0] for s in specials), dtype=int, count=n)
+        ys = np.fromiter((s[1] for s in specials), dtype=int, count=n)
+        colours = np.fromiter((self.colour_codes.get(s[2], -1) for s in specials), dtype=int, count=n)
+        rewards = np.fromiter((s[3] for s in specials), dtype=float, count=n)
+        velocities = np.fromiter((self.velocity_codes.get(s[4], -1) for s in specials), dtype=int, count=n)
+        return xs, ys, colours, rewards, velocities
+
+    def move_specials(self, xs, ys, velocities, wall_map):
+        # vectorized World.update_specials bounce rule, works on any array shape:
+        # step along the velocity, on a wall or grid edge reverse and jump two cells back
+        dx = np.where(velocities == 2, -1, np.where(velocities == 3, 1, 0))
+        dy = np.where(velocities == 0, -1, np.where(velocities == 1, 1, 0))
+        nx = xs + dx
+        ny = ys + dy
+        in_bounds = (nx >= 0) & (nx < self.x_dim) & (ny >= 0) & (ny < self.y_dim)
+        blocked = ~in_bounds
+        blocked[in_bounds] = wall_map[nx[in_bounds], ny[in_bounds]]
+        blocked &= velocities >= 0
+        nx = np.where(blocked, xs - dx, nx)
+        ny = np.where(blocked, ys - dy, ny)
+        # up <-> down, left <-> right
+        nv = np.where(blocked, velocities ^ 1, velocities)
+        return nx, ny, nv
+
+    def update_specials(self, specials, walls):
+        """ Returns the specials list after one World.update_specials call """
+        return list(self.__get_layout(specials, walls)[1])
+
+    def __get_layout(self, specials, walls):
+        key = (tuple(specials), self.get_walls_key(walls))
+        layout = self.layouts.get(key)
+        if layout is not None:
+            return layout
+        if len(self.layouts) >= self.max_layouts:
+            self.layouts.clear()
+
+        cell_rewards = dict()
+        for special in specials:
+            # only the first special on a cell is collected while standing on it
+            cell_rewards.setdefault((special[0], special[1]), special[3])
+
+        xs, ys, colours, rewards, velocities = self.pack_specials(specials)
+        red = colours == 0
+        if np.any(velocities[red] >= 0):
+            nx, ny, nv = self.move_specials(xs[red], ys[red], velocities[red],
+                                            self.get_wall_map(walls))
+            reds = [s for s in specials if s[2] == "red"]
+            moved = [(int(i), int(j), s[2], s[3], self.velocity_names[v] if v >= 0 else s[4])
+                     for i, j, v, s in zip(nx, ny, nv, reds)]
+        else:
+            moved = [s for s in specials if s[2] == "red"]
+        next_specials = moved + [s for s in specials if s[2] == "green"]
+
+        next_cell_rewards = dict()
+        for special in next_specials:
+            next_cell_rewards.setdefault((special[0], special[1]), []).append(special[3])
+
+        layout = (cell_rewards, next_specials, next_cell_rewards)
+        self.layouts[key] = layout
+        return layout
+
+    def __get_batch_layout(self, specials, walls):
+        key = (tuple(specials), self.get_walls_key(walls))
+        batch_layout = self.batch_layouts.get(key)
+        if batch_layout is not None:
+            return batch_layout
+        if len(self.batch_layouts) >= self.max_layouts:
+            self.batch_layouts.clear()
+        cell_rewards, next_specials, next_cell_rewards = self.__get_layout(specials, walls)
+
+        def to_arrays(cells, rewards):
+            # cells are encoded as x * y_dim + y, off-grid cells can never be reached
+            on_grid = [(c, r) for c, r in zip(cells, rewards)
+                       if 0 <= c[0] < self.x_dim and 0 <= c[1] < self.y_dim]
+            ids = np.array([c[0] * self.y_dim + c[1] for c, _ in on_grid], dtype=int)
+            vals = np.array([r for _, r in on_grid], dtype=float)
+            order = np.argsort(ids)
+            return ids[order], vals[order]
+
+        # rewards for landing on a cell, accumulated in the same order as step()
+        landing_rewards = []
+        for cell_specials in next_cell_rewards.values():
+            reward = self.walk_reward
+            for special_reward in cell_specials:
+                reward -= self.walk_reward
+                reward += special_reward
+            landing_rewards.append(reward)
+        # the next specials are shared by every row of every batch, so they are
+        # kept immutable
+        batch_layout = to_arrays(cell_rewards.keys(), cell_rewards.values()) + \
+            to_arrays(next_cell_rewards.keys(), landing_rewards) + (tuple(next_specials),)
+        self.batch_layouts[key] = batch_layout
+        return batch_layout
+
+    def lookup_cells(self, cell_ids, table_ids):
+        # vectorized membership of cell ids in a sorted id table
+        if not len(table_ids):
+            return np.zeros(len(cell_ids), dtype=bool), np.zeros(len(cell_ids), dtype=int)
+        idxs = np.minimum(np.searchsorted(table_ids, cell_ids), len(table_ids) - 1)
+        return table_ids[idxs] == cell_ids, idxs
+
+    def step_batch(self, states, action_idxs, specials, walls):
+        """ Steps N states with N action indices under one specials/walls layout.
+            Returns rewards, new states, a mask of states frozen on a special and
+            the (tuple of) next specials """
+        stand_ids, stand_rewards, land_ids, land_rewards, next_specials = \
+            self.__get_batch_layout(specials, walls)
+        states = np.asarray(states, dtype=int).reshape(-1, 2)
+        x, y = states[:, 0], states[:, 1]
+        # no movement out of terminal states
+        frozen, stand_idxs = self.lookup_cells(x * self.y_dim + y, stand_ids)
+
+        deltas = self.deltas[np.asarray(action_idxs, dtype=int)]
+        new_x = x + deltas[:, 0]
+        new_y = y + deltas[:, 1]
+        in_bounds = (new_x >= 0) & (new_x < self.x_dim) & (new_y >= 0) & (new_y < self.y_dim)
+        stay = frozen | ~in_bounds
+        stay[in_bounds] |= self.get_wall_map(walls)[new_x[in_bounds], new_y[in_bounds]]
+        new_x = np.where(stay, x, new_x)
+        new_y = np.where(stay, y, new_y)
+
+        landed, land_idxs = self.lookup_cells(new_x * self.y_dim + new_y, land_ids)
+        rewards = np.full(len(states), self.walk_reward)
+        if len(land_ids):
+            rewards = np.where(landed, land_rewards[land_idxs], rewards)
+        if len(stand_ids):
+            rewards = np.where(frozen, stand_rewards[stand_idxs], rewards)
+        return rewards, np.stack((new_x, new_y), axis=1), frozen, next_specials
+
+    def is_blocked(self, wall_map, x, y):
+        return not ((0 <= x < self.x_dim) and (0 <= y < self.y_dim)) or wall_map[x, y]
+
+    def step(self, state, action, specials, walls):
+        """ Returns <orig_state, action, reward, new_state, specials> tuple """
+        cell_rewards, next_specials, next_cell_rewards = self.__get_layout(specials, walls)
+        return self.__step(state, action, specials, walls, cell_rewards,
+                           next_specials, next_cell_rewards)
+
+    def step_at(self, state, action, trajectory, t):
+        """ Same as step, with the specials at time t and t + 1 (and the walls)
+            taken from a precomputed SpecialsTrajectory """
+        reward, new_state, frozen = self.move_at(state, action, trajectory, t)
+        return state, action, reward, new_state, trajectory.at(t if frozen else t + 1)
+
+    def move_at(self, state, action, trajectory, t):
+        """ Returns (reward, new_state, frozen) of step_at, looking up collisions in
+            the wall bitmap and the trajectory's cell index only """
+        x, y = state[0], state[1]
+        # no movement out of terminal states
+        stand_rewards = trajectory.get_cell_rewards(x, y, t)
+        if len(stand_rewards):
+            return stand_rewards[0], (x, y), True
+
+        dx, dy = self.deltas[self.actions.index(action)]
+        new_x, new_y = x + int(dx), y + int(dy)
+        reward = self.walk_reward
+        if self.is_blocked(trajectory.wall_map, new_x, new_y):
+            new_x, new_y = x, y
+        for special_reward in trajectory.get_cell_rewards(new_x, new_y, t + 1):
+            reward -= self.walk_reward
+            reward += special_reward
+        return reward, (new_x, new_y), False
+
+    def __step(self, state, action, specials, walls, cell_rewards, next_specials, next_cell_rewards):
+        x, y = state[0], state[1]
+        # no movement out of terminal states
+        if (x, y) in cell_rewards:
+            return state, action, cell_rewards[(x, y)], (x, y), specials
+
+        dx, dy = self.deltas[self.actions.index(action)]
+        new_x, new_y = x + int(dx), y + int(dy)
+        reward = self.walk_reward
+        if self.is_blocked(self.get_wall_map(walls), new_x, new_y):
+            new_x, new_y = x, y
+        for special_reward in next_cell_rewards.get((new_x, new_y), ()):
+            reward -= self.walk_reward
+            reward += special_reward
+        return state, action, reward, (new_x, new_y), list(next_specials)
+
+    def get_trajectory(self, specials, walls):
+        """ Returns the (cached) SpecialsTrajectory of specials under a wall layout """
+        key = (tuple(specials), self.get_walls_key(walls))
+        trajectory = self.trajectories.get(key)
+        if trajectory is None:
+            if len(self.trajectories) >= self.max_layouts:
+                self.trajectories.clear()
+            trajectory = SpecialsTrajectory(self, specials, walls)
+            self.trajectories[key] = trajectory
+        return trajectory
+
+
+class SpecialsTrajectory(object):
+    """Time indexed table of special positions. Walls are static, so every
+    special's (x, y, velocity) sequence is eventually periodic: special i
+    visits offsets[i] transient states and then repeats with periods[i].
+    Each special's states are stored once in flat (ragged) arrays, and an
+    inverse cell -> specials index answers "which specials are on this cell
+    at time t" without scanning all specials, whatever the map size."""
+
+    def __init__(self, engine, specials, walls, max_cached=256):
+        self.original_specials = list(specials)
+        # World.update_specials keeps reds then greens and drops anything else
+        self.specials = [s for s in specials if s[2] == "red"] + [s for s in specials if s[2] == "green"]
+        self.special_rewards = [s[3] for s in self.specials]
+        self.x_dim, self.y_dim = engine.x_dim, engine.y_dim
+        self.wall_map = engine.get_wall_map(walls)
+        xs, ys, colours, _, velocities = engine.pack_specials(self.specials)
+        # greens (and reds without a velocity) never move
+        velocities = np.where(colours == 0, velocities, -1)
+        n = len(self.specials)
+
+        def advance(state):
+            return engine.move_specials(state[0], state[1], state[2], self.wall_map)
+
+        def same(a, b):
+            return (a[0] == b[0]) & (a[1] == b[1]) & (a[2] == b[2])
+
+        def advance_where(mask, state):
+            moved = advance(state)
+            return tuple(np.where(mask, m, s) for m, s in zip(moved, state))
+
+        # floyd cycle detection, run for all specials at once
+        start = (xs, ys, velocities)
+        tortoise = advance(start)
+        hare = advance(tortoise)
+        active = ~same(tortoise, hare)
+        while np.any(active):
+            tortoise = advance_where(active, tortoise)
+            hare = advance_where(active, advance_where(active, hare))
+            active = ~same(tortoise, hare)
+
+        offsets = np.zeros(n, dtype=int)
+        tortoise = start
+        active = ~same(tortoise, hare)
+        while np.any(active):
+            tortoise = advance_where(active, tortoise)
+            hare = advance_where(active, hare)
+            offsets += active
+            active = ~same(tortoise, hare)
+
+        periods = np.ones(n, dtype=int)
+        hare = advance(tortoise)
+        active = ~same(tortoise, hare)
+        while np.any(active):
+            hare = advance_where(active, hare)
+            periods += active
+            active = ~same(tortoise, hare)
+
+        self.offsets = offsets
+        self.periods = periods
+        # special i's state k steps after the start is at flat index starts[i] + k
+        lengths = offsets + periods
+        self.starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+        total = int(np.sum(lengths))
+        self.xs = np.empty(total, dtype=np.int32)
+        self.ys = np.empty(total, dtype=np.int32)
+        self.velocities = np.empty(total, dtype=np.int8)
+        ids = np.arange(n)
+        state = start
+        k = 0
+        while len(ids):
+            flat = self.starts[ids] + k
+            self.xs[flat], self.ys[flat], self.velocities[flat] = state
+            k += 1
+            keep = lengths[ids] > k
+            ids = ids[keep]
+            state = advance(tuple(arr[keep] for arr in state))
+
+        # inverse index: sorted cell ids, each with the (sorted) specials that ever visit it
+        on_grid = (self.xs >= 0) & (self.xs < self.x_dim) & (self.ys >= 0) & (self.ys < self.y_dim)
+        cells = self.xs.astype(np.int64) * self.y_dim + self.ys
+        owners = np.repeat(np.arange(n), lengths)
+        pairs = np.unique(cells[on_grid] * max(n, 1) + owners[on_grid])
+        pair_cells = pairs // max(n, 1)
+        self.index_specials = pairs % max(n, 1)
+        self.index_cells, self.index_starts = np.unique(pair_cells, return_index=True)
+        self.index_starts = np.append(self.index_starts, len(pairs))
+        self.visited = np.zeros((self.x_dim, self.y_dim), dtype=bool)
+        self.visited[self.xs[on_grid], self.ys[on_grid]] = True
+
+        # the original ordering only applies before the first move
+        self.start_cells = dict()
+        for special in self.original_specials:
+            self.start_cells.setdefault((special[0], special[1]), []).append(special[3])
+
+        # joint (offset, period) of all specials, python ints cannot overflow the lcm
+        self.offset = int(np.max(offsets)) if n else 0
+        self.period = reduce(lambda a, b: a * b // gcd(a, b), periods.tolist(), 1)
+
+        self.velocity_names = engine.velocity_names
+        self.max_cached = max_cached
+        self.specials_cache = dict()
+
+    def get_index(self, t, ids=None):
+        # flat table index of specials ids (default all) at time t
+        offsets = self.offsets if ids is None else self.offsets[ids]
+        periods = self.periods if ids is None else self.periods[ids]
+        starts = self.starts if ids is None else self.starts[ids]
+        return starts + np.where(t < offsets, t, offsets + (t - offsets) % periods)
+
+    def positions(self, t):
+        """ Returns (xs, ys, velocities) arrays of all specials at time t """
+        idxs = self.get_index(t)
+        return self.xs[idxs], self.ys[idxs], self.velocities[idxs]
+
+    def __get_key(self, t):
+        # times in the same phase of the joint period share a specials configuration,
+        # t = 0 is kept apart since it has the original specials ordering
+        if not t:
+            return None
+        return t if t < self.offset else self.offset + (t - self.offset) % self.period
+
+    def at(self, t):
+        """ Returns the specials list at time t, as World.update_specials would after t moves """
+        key = self.__get_key(t)
+        specials = self.specials_cache.get(key)
+        if specials is None:
+            if not t:
+                specials = self.original_specials
+            else:
+                xs, ys, velocities = self.positions(t)
+                specials = [(int(i), int(j), s[2], s[3], self.velocity_names[v] if v >= 0 else s[4])
+                            for i, j, v, s in zip(xs, ys, velocities, self.specials)]
+            if len(self.specials_cache) >= self.max_cached:
+                self.specials_cache.clear()
+            self.specials_cache[key] = specials
+        return list(specials)
+
+    def get_specials_on(self, x, y, t):
+        """ Returns the ids (in collection order) of the specials on cell (x, y) at time t """
+        if not ((0 <= x < self.x_dim) and (0 <= y < self.y_dim)) or not self.visited[x, y]:
+            return ()
+        i = np.searchsorted(self.index_cells, x * self.y_dim + y)
+        candidates = self.index_specials[self.index_starts[i]:self.index_starts[i + 1]]
+        idxs = self.get_index(t, candidates)
+        return candidates[(self.xs[idxs] == x) & (self.ys[idxs] == y)]
+
+    def get_cell_rewards(self, x, y, t):
+        """ Returns the rewards of the specials on cell (x, y) at time t, in collection order """
+        if not t:
+            return self.start_cells.get((x, y), [])
+        return [self.special_rewards[i] for i in self.get_specials_on(x, y, t)]
@@ -49,6 +49,13 @@ class HistoryManager(object):
         else:
             self.state_count_dict[tuple(observation[3])] = 1
 
+    def add_batch(self, orig_states, actions, rewards, new_states, times):
+        # one observation per row, e.g. the arrays returned by VectorWorld.step
+        for orig_state, action, reward, new_state, time in zip(orig_states, actions, rewards,
+                                                               new_states, times):
+            self.add((list(map(int, orig_state)), action, float(reward),
+                      tuple(map(int, new_state)), int(time)))
+
 
 class BootstrapHistoryManager(HistoryManager):
     def __init__(self, actions, batch_prop, penalty_threshold=-1):
@@ -0,0 +1,140 @@
+import numpy as np
+import world
+from gridEngine import GridEngine
+
+
+class DistanceLeafEvaluator(object):
+    """Values the leaves of the lookahead tree as if the agent walked the
+    shortest path to the goal: walk rewards on the way, then the goal reward,
+    discounted per move like the tree itself. Shortest path distances to the
+    goal are found by a BFS over the grid and cached per (walls, goal)."""
+
+    def __init__(self, walls=world.static_walls, x_dim=world.static_x_dim, y_dim=world.static_y_dim,
+                 max_tables=64):
+        self.walls = list(walls)
+        self.engine = GridEngine(x_dim, y_dim)
+        self.walk_reward = self.engine.walk_reward
+        self.max_tables = max_tables
+        # (walls key, goal) -> distance table indexed [x, y], -1 if unreachable
+        self.tables = dict()
+        # moves past the leaves whose specials evaluate needs
+        self.depth = 0
+
+    def get_distances(self, walls, goal_state):
+        """ Moves from every cell to goal_state, the known walls are always included """
+        walls = tuple(sorted(set(map(tuple, self.walls)) | set(map(tuple, walls))))
+        key = (walls, tuple(goal_state))
+        distances = self.tables.get(key)
+        if distances is None:
+            if len(self.tables) >= self.max_tables:
+                self.tables.clear()
+            distances = self.__bfs(self.engine.get_wall_map(walls), goal_state)
+            self.tables[key] = distances
+        return distances
+
+    def __bfs(self, wall_map, goal_state):
+        # moves are reversible, so the distance from the goal is the distance to it
+        distances = np.full(wall_map.shape, -1, dtype=int)
+        frontier = np.zeros(wall_map.shape, dtype=bool)
+        frontier[goal_state[0], goal_state[1]] = True
+        distances[frontier] = 0
+        distance = 0
+        while frontier.any():
+            distance += 1
+            reached = np.zeros(wall_map.shape, dtype=bool)
+            reached[1:, :] |= frontier[:-1, :]
+            reached[:-1, :] |= frontier[1:, :]
+            reached[:, 1:] |= frontier[:, :-1]
+            reached[:, :-1] |= frontier[:, 1:]
+            frontier = reached & ~wall_map & (distances < 0)
+            distances[frontier] = distance
+        return distances
+
+    def evaluate(self, states, walls, goal_state, goal_reward, discount_factor, specials=None):
+        """ Value estimates of the decision nodes at states (an (N, 2) array) """
+        states = np.asarray(states).reshape(-1, 2)
+        distances = self.get_distances(walls, goal_state)[states[:, 0], states[:, 1]]
+        # d - 1 walk rewards then the goal reward, discounted from one move ahead
+        steps = np.maximum(distances, 1)
+        if discount_factor == 1:
+            walk = self.walk_reward * (steps - 1)
+        else:
+            walk = self.walk_reward * (discount_factor - discount_factor ** steps) / (1 - discount_factor)
+        values = walk + discount_factor ** steps * goal_reward
+        # the goal reward was collected on landing, and an unreachable goal
+        # has nothing to expect
+        return np.where(distances > 0, values, 0.0)
+
+
+class RolloutLeafEvaluator(object):
+    """Values the leaves of the lookahead tree by the mean discounted return
+    of n_rollouts rollouts of rollout_length moves each, against the predicted
+    specials. Moves are random, or greedy along the shortest path to the goal.
+    The rollouts of all leaves advance together, one sim_batch call per move
+    and specials configuration."""
+
+    policies = ["random", "greedy"]
+
+    def __init__(self, simulator, n_rollouts=8, rollout_length=5, policy="random",
+                 walls=world.static_walls, x_dim=world.static_x_dim, y_dim=world.static_y_dim,
+                 random_state=None):
+        if policy not in self.policies:
+            raise Exception("Unknown rollout policy: " + str(policy))
+        self.simulator = simulator
+        self.n_rollouts = n_rollouts
+        self.rollout_length = rollout_length
+        self.policy = policy
+        # greedy moves follow the distance tables
+        self.distances = DistanceLeafEvaluator(walls, x_dim, y_dim)
+        self.random = np.random.RandomState(random_state)
+        # moves past the leaves whose specials evaluate needs
+        self.depth = rollout_length
+
+    def evaluate(self, states, walls, goal_state, goal_reward, discount_factor, specials=None):
+        """ Value estimates of the decision nodes at states (an (N, 2) array); specials[j] are
+            the specials configurations of the j-th move past the leaves, rollout k plays
+            against configuration k of every move (modulo their number) """
+        states = np.asarray(states, dtype=int).reshape(-1, 2)
+        n_leaves = len(states)
+        positions = np.repeat(states, self.n_rollouts, axis=0)
+        configs = np.tile(np.arange(self.n_rollouts), n_leaves)
+        returns = np.zeros(len(positions))
+        # a rollout ends when it stands on a special, like the game
+        done = np.zeros(len(positions), dtype=bool)
+        for step in range(self.rollout_length):
+            step_configs = specials[step]
+            config_ids = configs % len(step_configs)
+            for k, config in enumerate(step_configs):
+                done |= (config_ids == k) & self.__in_cells(positions, config)
+            active = np.flatnonzero(~done)
+            if not len(active):
+                break
+            actions = self.__get_actions(positions[active], walls, goal_state)
+            for k, config in enumerate(step_configs):
+                rows = active[config_ids[active] == k]
+                if not len(rows):
+                    continue
+                rewards, new_positions, _ = self.simulator.sim_batch(positions[rows], actions[config_ids[active] == k],
+                                                                     specials=config, walls=walls)
+                returns[rows] += discount_factor ** (step + 1) * rewards
+                positions[rows] = new_positions
+        return returns.reshape(n_leaves, self.n_rollouts).mean(axis=1)
+
+    def __get_actions(self, positions, walls, goal_state):
+        if self.policy == "random":
+            return np.asarray(GridEngine.actions)[self.random.randint(len(GridEngine.actions), size=len(positions))]
+        # the move onto the cell closest to the goal, ties broken at random
+        distances = self.distances.get_distances(walls, goal_state)
+        x_dim, y_dim = distances.shape
+        targets = positions[:, np.newaxis, :] + GridEngine.deltas[np.newaxis, :, :]
+        on_grid = (targets[:, :, 0] >= 0) & (targets[:, :, 0] < x_dim) & \
+                  (targets[:, :, 1] >= 0) & (targets[:, :, 1] < y_dim)
+        target_distances = distances[np.clip(targets[:, :, 0], 0, x_dim - 1), np.clip(targets[:, :, 1], 0, y_dim - 1)]
+        # walls and unreachable cells are -1, off grid cells are never taken
+        costs = np.where(on_grid & (target_distances >= 0), target_distances, x_dim * y_dim).astype(float)
+        costs += self.random.uniform(0, 0.5, size=costs.shape)
+        return np.asarray(GridEngine.actions)[np.argmin(costs, axis=1)]
+
+    def __in_cells(self, positions, specials):
+        cells = np.array([(s[0], s[1]) for s in specials], dtype=int).reshape(-1, 2)
+        return np.any(np.all(positions[:, np.newaxis, :] == cells[np.newaxis, :, :], axis=2), axis=1)
@@ -2,10 +2,13 @@ import world
 import random
 import logger
 from mdpSimulator import WorldSimulator
+from gridEngine import WallLayout
 from bayesSparse import SparseTreeEvaluator
 from historyManager import HistoryManager, BootstrapHistoryManager
 from thompsonSampling import ThompsonSampler
 from gpPosterior import GPPosterior
+from leafEvaluators import DistanceLeafEvaluator, RolloutLeafEvaluator
+from mctsPlanner import MCTSEvaluator
 from sklearn.gaussian_process.kernels import ExpSineSquared
 import pickle
 import sys
@@ -19,7 +22,7 @@ def sparse_tree_model_tester(arg_dict):
     goal_reward = 10
     loss_penalty = -10
     original_root = root_state.copy()
-    horizon = 10
+    horizon = int(arg_dict['horizon']) if 'horizon' in arg_dict else 10
     if 'ep_len' in arg_dict and int(arg_dict['ep_len']):
         print("Setting episode length:", arg_dict['ep_len'], "...")
         episode_length = int(arg_dict['ep_len'])
@@ -46,6 +49,23 @@ def sparse_tree_model_tester(arg_dict):
                                            move_weight=move_wght, move_discount=0.5,
                                            num_dirch_samples=100)
     discount_factor = 0.5
+    array_tree = 'array_tree' in arg_dict
+    transpositions = 'transpositions' in arg_dict
+    reuse_tree = 'reuse_tree' in arg_dict
+    n_workers = int(arg_dict['n_workers']) if 'n_workers' in arg_dict else 0
+    split_depth = int(arg_dict['split_depth']) if 'split_depth' in arg_dict else 1
+    time_budget = float(arg_dict['time_budget']) if 'time_budget' in arg_dict else None
+    node_budget = int(arg_dict['node_budget']) if 'node_budget' in arg_dict else None
+    branch_factor = int(arg_dict['branch_factor']) if 'branch_factor' in arg_dict else None
+    streaming = 'streaming' in arg_dict
+    pruning = 'pruning' in arg_dict
+    close_terminals = 'close_terminals' in arg_dict
+    cycle_pruning = 'cycle_pruning' in arg_dict
+    planner = arg_dict['planner'] if 'planner' in arg_dict else "sparse"
+    if planner not in ["sparse", "mcts"]:
+        raise Exception("Unknown planner: " + planner)
+    mcts_iterations = int(arg_dict['mcts_iterations']) if 'mcts_iterations' in arg_dict else 1000
+    persistent_ste = None
     is_testing = False
     if "testing_file" in arg_dict:
         is_testing = True
@@ -70,9 +90,26 @@ def sparse_tree_model_tester(arg_dict):
     test_name = arg_dict['name']
     move_limit = int(arg_dict['move_limit'])
     root_path = arg_dict['root_path']
-    simulator = WorldSimulator()
-    true_specials = world.static_specials.copy()
-    true_walls = world.static_walls.copy()
+    simulator = WorldSimulator(x_dim=world.static_x_dim, y_dim=world.static_y_dim)
+    true_walls = WallLayout(world.static_walls)
+    # leaves of the lookahead tree valued by their shortest path to the goal,
+    # or by rollouts against the predicted specials
+    leaf_evaluator = None
+    if 'leaf_heuristic' in arg_dict:
+        if arg_dict['leaf_heuristic'] == "distance":
+            leaf_evaluator = DistanceLeafEvaluator(walls=true_walls, x_dim=world.static_x_dim,
+                                                   y_dim=world.static_y_dim)
+        elif arg_dict['leaf_heuristic'] == "rollout":
+            leaf_evaluator = RolloutLeafEvaluator(simulator,
+                                                  n_rollouts=int(arg_dict.get('n_rollouts', 8)),
+                                                  rollout_length=int(arg_dict.get('rollout_length', 5)),
+                                                  policy=arg_dict.get('rollout_policy', "random"),
+                                                  walls=true_walls, x_dim=world.static_x_dim,
+                                                  y_dim=world.static_y_dim)
+        else:
+            raise Exception("Unknown leaf heuristic: " + arg_dict['leaf_heuristic'])
+    # red specials are periodic, their positions are looked up by game time
+    true_trajectory = simulator.get_specials_trajectory(world.static_specials, true_walls)
     total_move_count = 0
     game_move_count = 0
     episode_count = 0
@@ -81,7 +118,18 @@ def sparse_tree_model_tester(arg_dict):
     kernel = ExpSineSquared(length_scale=2, periodicity=3.0,
                             periodicity_bounds=(2, 10),
                             length_scale_bounds=(1, 10))
-    gp = GPPosterior(history_manager=history_manager, kernel=kernel, log=None)
+    # incremental posterior updates only re-optimize the kernel every gp_reoptimize_every games
+    # re-optimizations may start from the previous optimum, stop restarting
+    # early and run on a thread pool
+    gp = GPPosterior(history_manager=history_manager, kernel=kernel, log=None,
+                     incremental='gp_incremental' in arg_dict,
+                     reoptimize_every=int(arg_dict['gp_reoptimize_every']) if 'gp_reoptimize_every' in arg_dict
+                     else 10,
+                     warm_start='gp_warm_start' in arg_dict,
+                     restart_patience=int(arg_dict['gp_restart_patience']) if 'gp_restart_patience' in arg_dict
+                     else None,
+                     n_jobs=int(arg_dict['gp_jobs']) if 'gp_jobs' in arg_dict else 0,
+                     periodic='gp_periodic' in arg_dict)
     ############################
     # used for testing purposes
     ############################
@@ -96,15 +144,49 @@ def sparse_tree_model_tester(arg_dict):
 
 
     def eval_sparse_tree(sim, root_s, actions, horizon, tsampler=None):
-        ste = SparseTreeEvaluator(sim, root_s, actions, horizon,
-                                  history_manager=history_manager,
-                                  thompson_sampler=tsampler,
-                                  discount_factor=discount_factor,
-                                  state_posterior=gp,
-                                  goal_state=goal_state,
-                                  goal_reward=goal_reward,
-                                  loss_penalty=loss_penalty)
-        ste.evaluate(game_move_count)
+        nonlocal persistent_ste
+        if persistent_ste:
+            # the evaluator decides itself whether its last tree is still valid
+            ste = persistent_ste
+            ste.goal_state = goal_state
+        elif planner == "mcts":
+            ste = MCTSEvaluator(sim, root_s, actions, horizon,
+                                history_manager=history_manager,
+                                thompson_sampler=tsampler,
+                                discount_factor=discount_factor,
+                                state_posterior=gp,
+                                goal_state=goal_state,
+                                goal_reward=goal_reward,
+                                loss_penalty=loss_penalty,
+                                n_iterations=mcts_iterations,
+                                time_budget=time_budget,
+                                leaf_evaluator=leaf_evaluator)
+        else:
+            ste = SparseTreeEvaluator(sim, root_s, actions, horizon,
+                                      history_manager=history_manager,
+                                      thompson_sampler=tsampler,
+                                      discount_factor=discount_factor,
+                                      state_posterior=gp,
+                                      goal_state=goal_state,
+                                      goal_reward=goal_reward,
+                                      loss_penalty=loss_penalty,
+                                      array_tree=array_tree,
+                                      transpositions=transpositions,
+                                      reuse_tree=reuse_tree,
+                                      n_workers=n_workers,
+                                      split_depth=split_depth,
+                                      time_budget=time_budget,
+                                      node_budget=node_budget,
+                                      branch_factor=branch_factor,
+                                      streaming=streaming,
+                                      pruning=pruning,
+                                      close_terminals=close_terminals,
+                                      cycle_pruning=cycle_pruning,
+                                      leaf_evaluator=leaf_evaluator)
+            # the worker pool lives as long as the evaluator
+            if reuse_tree or n_workers > 1:
+                persistent_ste = ste
+        ste.evaluate(game_move_count, root_state=root_s)
         print(ste)
         optimal_action_index = random.choice(ste.lookahead_tree.node.value[0])
         possible_actions = ste.lookahead_tree.actions
@@ -112,6 +194,17 @@ def sparse_tree_model_tester(arg_dict):
         optimal_action = possible_actions[optimal_action_index]
         print("Optimal action:", str(optimal_action), ":", optimal_action_index)
         print("Tree size: ", ste.lookahead_tree.get_tree_size())
+        if reuse_tree:
+            print("Reused nodes: ", ste.lookahead_tree.reused_nodes)
+        if planner == "mcts":
+            print("Search iterations: ", ste.iterations, "simulated transitions: ", ste.simulations)
+        if time_budget is not None or node_budget is not None:
+            print("Depth reached: ", ste.depth_reached, "/", horizon)
+        if pruning:
+            print("Pruned nodes: ", ste.nodes_pruned)
+        if cycle_pruning:
+            print("Pruned backtracks: ", ste.backtracks_pruned, "revisits: ", ste.revisits_pruned)
+        print("Sim cache:", sim.get_cache_stats()["sim"])
         return optimal_action, optimal_action_index, possible_actions, ste
 
     while True:
@@ -120,11 +213,8 @@ def sparse_tree_model_tester(arg_dict):
         optimal_action, optimal_action_index, possible_actions, ste = \
             eval_sparse_tree(simulator, root_state, action_set, horizon, thompson_sampler)
         # real world
-        orig_state, action, new_reward, new_state, new_specials = simulator.sim(root_state, optimal_action,
-                                                                  specials=true_specials,
-                                                                  walls=true_walls)
-        # record change in true specials after move
-        true_specials = new_specials
+        orig_state, action, new_reward, new_state, new_specials = simulator.sim_at(root_state, optimal_action,
+                                                                     true_trajectory, game_move_count)
 
         # prev_root = root_state.copy()
         root_state = list(new_state)
@@ -187,6 +277,8 @@ def sparse_tree_model_tester(arg_dict):
             if not is_testing:
                 with open(root_path + "/" + test_name + batch_id + '.out', 'wb') as output:
                     pickle.dump(gp, output, pickle.HIGHEST_PROTOCOL)
+            if persistent_ste:
+                persistent_ste.close()
             return
 
         # check terminal conditions
@@ -199,9 +291,13 @@ def sparse_tree_model_tester(arg_dict):
             if is_testing:
                 new_goal_state()
             root_state = original_root.copy()
-            true_specials = world.static_specials.copy()
+            # the goal may have moved, trajectories are cached per layout
+            true_trajectory = simulator.get_specials_trajectory(world.static_specials, true_walls)
             if not (game_move_count > episode_move_limit):
                 gp.update_posterior()
+                if gp.update_time is not None:
+                    print("Posterior updated in", round(gp.update_time, 3), "s,",
+                          sum(timing[3] for timing in gp.fit_timings), "optimizer runs")
             game_move_count = 0
             logger.log("reset", logger=log)
             # check if end of training episode
@@ -227,16 +323,43 @@ def sparse_tree_model_tester(arg_dict):
 # bootstrap (T/F)
 # ep_len (int)
 # testing (directory path)
+# array_tree (T/F)
+# transpositions (T/F)
+# reuse_tree (T/F)
+# n_workers (int)
+# split_depth (int)
+# time_budget (seconds)
+# node_budget (int)
+# branch_factor (int)
+# streaming (T/F)
+# pruning (T/F)
+# close_terminals (T/F)
+# cycle_pruning (T/F)
+# horizon (int)
+# leaf_heuristic (distance/rollout)
+# n_rollouts (int)
+# rollout_length (int)
+# rollout_policy (random/greedy)
+# planner (sparse/mcts)
+# mcts_iterations (int)
+# gp_incremental (T/F)
+# gp_reoptimize_every (int)
+# gp_warm_start (T/F)
+# gp_restart_patience (int)
+# gp_jobs (int)
+# gp_periodic (T/F)
 
-arg_dict = dict()
-args = sys.argv
-for arg in args:
-    if "=" in arg:
-        arg_dict[arg.split("=")[0]] = arg.split("=")[1]
-
-if 'testing' in  arg_dict:
-    for filename in os.listdir(arg_dict["testing"]+"\\"):
-        arg_dict["testing_file"] = arg_dict["testing"] + "\\" +filename
-        sparse_tree_model_tester(arg_dict)
-else:
-    sparse_tree_model_tester(arg_dict)
\ No newline at end of file
+# guarded so that spawned pool workers (n_workers) do not start a run of their own
+if __name__ == "__main__":
+    arg_dict = dict()
+    args = sys.argv
+    for arg in args:
+        if "=" in arg:
+            arg_dict[arg.split("=")[0]] = arg.split("=")[1]
+
+    if 'testing' in  arg_dict:
+        for filename in os.listdir(arg_dict["testing"]+"\\"):
+            arg_dict["testing_file"] = arg_dict["testing"] + "\\" +filename
+            sparse_tree_model_tester(arg_dict)
+    else:
+        sparse_tree_model_tester(arg_dict)
\ No newline at end of file
@@ -0,0 +1,219 @@
+import time
+import numpy as np
+from bayesSparse import SparseTree, NodeType, predict_specials, get_level_specials, filter_root_specials
+
+
+class SearchTree(SparseTree):
+    """SparseTree node with the statistics of the search: visits, the sum and
+    the best of the returns backed up through it"""
+
+    def __init__(self, node, parent, actions=None, reward=0.0):
+        SparseTree.__init__(self, node, parent, actions)
+        self.reward = reward
+        self.visits = 0
+        self.total = 0.0
+        self.best = None
+        self.expanded = False
+        # every path below ends at the horizon or on a frozen state
+        self.complete = False
+
+
+class MCTSEvaluator(object):
+    """UCT search over the lookahead tree of SparseTreeEvaluator, with the same
+    constructor arguments and result: after evaluate(t) the lookahead_tree root
+    holds (best_action_indexes, max_value, [action_values]) and its move pool.
+    A decision node is expanded on its first visit, all its actions in one
+    sim_batch call, and valued by a random rollout to the horizon (or by the
+    leaf_evaluator). Transitions are deterministic given the predicted specials,
+    so an action is worth the best return found below it; the mean return
+    drives the UCB1 selection. The search stops after n_iterations, after
+    time_budget seconds, or once the whole tree has been expanded."""
+
+    def __init__(self, mdp_simulator, root_state, action_set, horizon,
+                 history_manager, state_posterior, goal_state, goal_reward,
+                 loss_penalty, thompson_sampler=None, discount_factor=0.05,
+                 n_iterations=1000, time_budget=None, exploration=1.0,
+                 leaf_evaluator=None, random_state=None):
+        self.simulator = mdp_simulator
+        self.root_state = root_state
+        self.action_set = action_set
+        self.horizon = horizon
+        self.lookahead_tree = None
+        self.thompson_sampler = thompson_sampler
+        self.discount_factor = discount_factor
+        self.history_manager = history_manager
+        self.state_posterior = state_posterior
+        self.goal_state = goal_state
+        self.loss_penalty = loss_penalty
+        self.goal_reward = goal_reward
+        self.ignored_specials = []
+        self.n_iterations = n_iterations
+        self.time_budget = time_budget
+        self.exploration = exploration
+        self.leaf_evaluator = leaf_evaluator
+        self.leaf_depth = leaf_evaluator.depth if leaf_evaluator is not None else 0
+        self.random = np.random.RandomState(random_state)
+        self.level_specials = None
+        # search statistics of the last evaluate
+        self.iterations = 0
+        self.simulations = 0
+        self.depth_reached = None
+        self.nodes_expanded = None
+
+    def evaluate(self, t, root_state=None):
+        start_time = time.time()
+        if root_state is not None:
+            self.root_state = root_state
+        self.ignored_specials = []
+        self.iterations = 0
+        self.simulations = 0
+        # simulations are the transitions the simulator stepped, not its cache hits
+        steps_simulated = self.simulator.steps_simulated
+        specials = predict_specials(self.state_posterior, range(t - 1, t + self.horizon + self.leaf_depth + 2),
+                                    self.loss_penalty)
+        self.level_specials = [get_level_specials(specials, depth, self.goal_state, self.goal_reward)
+                               for depth in range(self.horizon + self.leaf_depth)]
+        statics = self.state_posterior.get_static_states()
+
+        root = SearchTree(SparseTree.Node(NodeType.Decision, 0, self.root_state, []), None)
+        root_specials, root.actions = self.__get_root_actions(root, statics)
+        self.__expand(root, root.actions, root_specials, statics)
+        root.complete = not root.children
+        while not root.complete:
+            # every root action is tried once, whatever the budget
+            if all(child.visits for child in root.children):
+                if self.iterations >= self.n_iterations:
+                    break
+                if self.time_budget is not None and time.time() - start_time > self.time_budget:
+                    break
+            self.__iterate(root, statics)
+            self.iterations += 1
+        self.simulations = self.simulator.steps_simulated - steps_simulated
+
+        # root value is (best_action_indexes, max_value, [action_values])
+        root_values = [child.best for child in root.children]
+        for child in root.children:
+            child.node.value = [child.best]
+        if not root_values:
+            print(root.node.state)
+            print(root.actions)
+        max_value = max(root_values)
+        max_idxs = [i for i, j in enumerate(root_values) if j == max_value]
+        root.node.value = (max_idxs, max_value, [root_values])
+        self.lookahead_tree = root
+        self.depth_reached = root.get_tree_depth()
+        self.nodes_expanded = root.get_tree_size()
+
+    def __str__(self):
+        children_str = "{"
+        for child in self.lookahead_tree.children:
+            children_str += " " + str(child.node)
+        children_str += "}"
+        return str(self.lookahead_tree.node) + " -> " + children_str
+
+    def __iterate(self, root, statics):
+        # select down to an unexpanded decision, expand and value it, back up
+        path = [root]
+        node = root
+        while node.expanded and node.children:
+            outcome = self.__select(node)
+            node = outcome.children[0]
+            path += [outcome, node]
+        depth = node.node.depth
+        if depth >= self.horizon:
+            value = self.__get_leaf_value(node, statics) if self.leaf_evaluator is not None else 0.0
+            node.complete = True
+        else:
+            self.__expand(node, self.action_set, self.level_specials[depth], statics)
+            if not node.children:
+                # frozen on a special, no value
+                value = 0.0
+                node.complete = True
+            elif self.leaf_evaluator is not None:
+                value = self.__get_leaf_value(node, statics)
+            else:
+                value = self.__rollout(node.node.state, depth, statics)
+        node.best = value
+        self.__backup(path, value)
+
+    def __select(self, node):
+        # UCB1 over the outcomes that still have unexpanded nodes below
+        best, best_score = None, None
+        log_visits = np.log(max(node.visits, 1))
+        for outcome in node.children:
+            if outcome.complete:
+                continue
+            if not outcome.visits:
+                return outcome
+            score = outcome.total / outcome.visits + self.exploration * np.sqrt(log_visits / outcome.visits)
+            if best is None or score > best_score:
+                best, best_score = outcome, score
+        return best
+
+    def __expand(self, node, pool, specials_t, statics):
+        node.expanded = True
+        if not pool:
+            return
+        depth = node.node.depth
+        # all moves of the node in one expand, the root pool is already valid
+        transitions = {action: (reward, child_state) for action, reward, child_state, _
+                       in self.simulator.expand(node.node.state, specials_t, statics, self.action_set)}
+        valid_actions = []
+        for action in pool:
+            if action not in transitions:
+                continue
+            reward, child_state = transitions[action]
+            valid_actions.append(action)
+            outcome = SearchTree(SparseTree.Node(NodeType.Outcome, depth, tuple(child_state), [reward]),
+                                 node, reward=reward)
+            node.add_child(outcome)
+            outcome.add_child(SearchTree(SparseTree.Node(NodeType.Decision, depth + 1,
+                                                         tuple(child_state), []), outcome))
+        if depth:
+            node.actions = valid_actions
+
+    def __backup(self, path, value):
+        node = path[-1]
+        node.visits += 1
+        node.total += value
+        for i in range(len(path) - 2, 0, -2):
+            outcome, parent, child = path[i], path[i - 1], path[i + 1]
+            value = (outcome.reward + value) * self.discount_factor
+            outcome.visits += 1
+            outcome.total += value
+            outcome.best = (outcome.reward + child.best) * self.discount_factor
+            outcome.complete = child.complete
+            parent.visits += 1
+            parent.total += value
+            parent.best = max(c.best for c in parent.children if c.best is not None)
+            parent.complete = all(c.complete for c in parent.children)
+
+    def __rollout(self, state, depth, statics):
+        # random moves down to the horizon, stopped by a special like the game
+        value, scale = 0.0, 1.0
+        for level in range(depth, self.horizon):
+            specials_t = self.level_specials[level]
+            if any(s[0] == state[0] and s[1] == state[1] for s in specials_t):
+                break
+            action = self.action_set[self.random.randint(len(self.action_set))]
+            rewards, states, _ = self.simulator.sim_batch([state], [action], specials=specials_t, walls=statics)
+            scale *= self.discount_factor
+            value += scale * float(rewards[0])
+            state = tuple(states[0].tolist())
+        return value
+
+    def __get_leaf_value(self, node, statics):
+        depth = node.node.depth
+        configs = [[specials_t] for specials_t in self.level_specials[depth:depth + self.leaf_depth]]
+        return float(self.leaf_evaluator.evaluate([node.node.state], statics, self.goal_state, self.goal_reward,
+                                                  self.discount_factor, specials=configs)[0])
+
+    def __get_root_actions(self, root, statics):
+        # same root move pool as SparseTreeEvaluator: non goal specials the
+        # root stands on are ignored, the thompson sampler may prune the pool
+        filtered_specials = filter_root_specials(root.node.state, self.level_specials[0], self.ignored_specials)
+        valid_actions = [action for action, _, _, _ in
+                         self.simulator.expand(root.node.state, filtered_specials, statics, self.action_set)]
+        if self.thompson_sampler is not None:
+            valid_actions = self.thompson_sampler.get_action_set(valid_actions)
+        return filtered_specials, valid_actions
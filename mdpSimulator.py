@@ -1,4 +1,7 @@
 import world
+import numpy as np
+from collections import OrderedDict
+from gridEngine import GridEngine, WallLayout
 
 
 class MDPSimulator(object):
@@ -10,56 +13,168 @@ class MDPSimulator(object):
     def get_valid_actions(self, root, actions, specials, walls):
         raise NotImplementedError("Unimplemented method!")
 
+    def expand(self, state, specials, walls, actions):
+        """ Simulates every action from state in one pass.
+            Returns the <action, reward, new_state, specials> tuples of the actions that move """
+        expansions = []
+        for action in actions:
+            _, _, sim_r, sim_n_s, sim_specials = self.sim(state, action, specials, walls)
+            if not list(sim_n_s) == list(state):
+                expansions.append((action, sim_r, sim_n_s, sim_specials))
+        return expansions
+
+    def sim_batch(self, states, actions, specials, walls):
+        """ Simulates states[i] under actions[i] for all i, with shared specials and walls.
+            Must return <rewards, new_states, specials> with one row per state; rows
+            may share their specials, so those should not be mutated """
+        rewards, new_states, new_specials = [], [], []
+        for state, action in zip(states, actions):
+            _, _, sim_r, sim_n_s, sim_specials = self.sim(state, action, specials, walls)
+            rewards.append(sim_r)
+            new_states.append(sim_n_s)
+            new_specials.append(sim_specials)
+        return np.array(rewards, dtype=float), np.array(new_states, dtype=int).reshape(-1, 2), new_specials
+
+
+class TransitionCache(object):
+    """Bounded LRU memo for simulated transitions"""
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.__evict()
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self.__evict()
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_stats(self):
+        return {"size": len(self.entries), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions}
+
+    def __evict(self):
+        while len(self.entries) > max(self.max_size, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class WorldSimulator(MDPSimulator):
-    WORLD_SIM_CACHE = dict()
-    WORLD_VALID_ACTIONS_CACHE = dict()
+    # shared between simulators, the tree re-simulates the same transitions across moves
+    WORLD_SIM_CACHE = TransitionCache()
+    # larger batches (whole tree levels) rarely repeat and are stepped uncached
+    CACHED_BATCH_ROWS = 256
+    # expand() results (the moving actions of a state), under its original name
+    WORLD_VALID_ACTIONS_CACHE = TransitionCache()
 
-    def __init__(self, do_render=False):
+    def __init__(self, do_render=False, cache_size=None, x_dim=world.static_x_dim, y_dim=world.static_y_dim):
         # perhaps init threadpool here
         self.do_render = do_render
+        # transitions are stepped headless, world.World is only used for rendering
+        self.engine = GridEngine(x_dim, y_dim)
+        self.walk_reward = self.engine.walk_reward
+        # transitions stepped by the engine, cache hits are not counted
+        self.steps_simulated = 0
+        if cache_size is not None:
+            # a cache_size of 0 disables memoization
+            self.WORLD_SIM_CACHE.resize(cache_size)
+            self.WORLD_VALID_ACTIONS_CACHE.resize(cache_size)
 
-    def __run(self, sim_world, sim_state, sim_action):
-        # maze doesnt need current state to simulate
-        # sim_world has initialized agent position
-        r = -sim_world.score
-        if sim_action == sim_world.actions[0]:
-            sim_world.try_move_idx(0)
-        elif sim_action == sim_world.actions[1]:
-            sim_world.try_move_idx(1)
-        elif sim_action == sim_world.actions[2]:
-            sim_world.try_move_idx(2)
-        elif sim_action == sim_world.actions[3]:
-            sim_world.try_move_idx(3)
-        else:
-            return
-        s2 = sim_world.player
-        r += sim_world.score
-        return r, s2
+    def get_layout_key(self, specials, walls):
+        # specials keep their order, it decides which special is collected on shared cells;
+        # the caches are shared between simulators, so the map size is part of the key
+        return (self.engine.x_dim, self.engine.y_dim, tuple(specials),
+                walls if isinstance(walls, WallLayout) else frozenset(walls))
+
+    def get_cache_key(self, state, specials, walls):
+        return (state[0], state[1]) + self.get_layout_key(specials, walls)
 
     def sim(self, state, action, specials, walls):
-        init_x, init_y = self.get_x_y(state)
-        sim_world = world.World(self.do_render, init_x=init_x, init_y=init_y,
-                                specials=specials, walls=walls)
-        sim_r, sim_n_s = self.__run(sim_world, state, action)
-        if self.do_render: sim_world.destroy()
-        # return values are: <orig_state, action, reward, new_state>
-        # print("Sim Result: ", state, action, sim_r, sim_n_s)
-        return state, action, sim_r, sim_n_s, sim_world.specials
+        # a batch of one, single transitions share the sim_batch path and cache
+        rewards, new_states, new_specials = self.sim_batch([state], [action], specials, walls)
+        # return values are: <orig_state, action, reward, new_state, specials>
+        return state, action, float(rewards[0]), tuple(new_states[0].tolist()), list(new_specials[0])
 
     def get_x_y(self, state):
         return state[0], state[1]
 
     def get_valid_actions(self, root, actions, specials, walls):
-        valid_actions = []
-        init_x, init_y = self.get_x_y(root)
-        for action in actions:
-            sim_world = world.World(self.do_render, init_x=init_x, init_y=init_y,
-                                    specials=specials, walls=walls)
-            sim_r, sim_n_s = self.__run(sim_world, root, action)
-            if not list(sim_n_s) == list(root):
-                valid_actions.append(action)
-        if self.do_render: sim_world.destroy()
-        return valid_actions
+        # callers (e.g. the thompson sampler) consume the returned list
+        return [action for action, _, _, _ in self.expand(root, specials, walls, actions)]
+
+    def expand(self, state, specials, walls, actions):
+        # all actions in one sim_batch call, memoized per state and layout
+        key = (tuple(actions), self.get_cache_key(state, specials, walls))
+        expansions = self.WORLD_VALID_ACTIONS_CACHE.get(key)
+        if expansions is None:
+            rewards, new_states, new_specials = self.sim_batch([state] * len(actions), actions, specials, walls)
+            expansions = tuple((action, reward, tuple(new_state), tuple(action_specials))
+                               for action, reward, new_state, action_specials
+                               in zip(actions, rewards.tolist(), new_states.tolist(), new_specials)
+                               if not new_state == list(state))
+            self.WORLD_VALID_ACTIONS_CACHE.put(key, expansions)
+        return [(action, reward, new_state, list(action_specials))
+                for action, reward, new_state, action_specials in expansions]
+
+    def sim_batch(self, states, actions, specials, walls):
+        # actions may be names or indices into GridEngine.actions
+        actions = np.asarray(actions)
+        if actions.dtype.kind not in "iu":
+            names, inverse = np.unique(actions, return_inverse=True)
+            actions = np.array([self.engine.actions.index(a) for a in names], dtype=int)[inverse]
+        actions = actions.astype(np.int64)
+        states = np.asarray(states, dtype=np.int64).reshape(-1, 2)
+        # memoized per (layout, state batch); callers get copies of the cached arrays
+        key = None
+        cached = None
+        if len(states) <= self.CACHED_BATCH_ROWS:
+            key = (self.get_layout_key(specials, walls), states.tobytes(), actions.tobytes())
+            cached = self.WORLD_SIM_CACHE.get(key)
+        if cached is None:
+            cached = self.engine.step_batch(states, actions, specials, walls)
+            self.steps_simulated += len(states)
+            if key is not None:
+                self.WORLD_SIM_CACHE.put(key, cached)
+        rewards, new_states, frozen, next_specials = cached
+        # states frozen on a special do not advance the specials; rows share
+        # one tuple, which callers cannot alter under the cache
+        current_specials = tuple(specials)
+        new_specials = [current_specials if f else next_specials for f in frozen]
+        return rewards.copy(), new_states.copy(), new_specials
+
+    def get_specials_trajectory(self, specials, walls):
+        # built once per (specials, walls) layout
+        return self.engine.get_trajectory(specials, walls)
 
+    def sim_at(self, state, action, trajectory, t):
+        """ sim() with the specials at time t (and the walls) read from a SpecialsTrajectory """
+        return self.engine.step_at(state, action, trajectory, t)
 
+    def get_cache_stats(self):
+        return {"sim": self.WORLD_SIM_CACHE.get_stats(),
+                "valid_actions": self.WORLD_VALID_ACTIONS_CACHE.get_stats()}
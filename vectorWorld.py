@@ -0,0 +1,102 @@
+import numpy as np
+import world
+from gridEngine import GridEngine
+
+
+class VectorWorld(object):
+    """N independent copies of the world.World dynamics stepped in lockstep.
+    Player positions, specials, scores and game times are (N, ...) arrays,
+    finished games are reset to the origin automatically."""
+
+    def __init__(self, n_envs, specials=world.static_specials, walls=world.static_walls,
+                 origin=(0, world.static_y_dim - 1), episode_move_limit=100,
+                 x_dim=world.static_x_dim, y_dim=world.static_y_dim):
+        self.n_envs = n_envs
+        self.engine = GridEngine(x_dim, y_dim)
+        self.actions = self.engine.actions
+        self.walk_reward = self.engine.walk_reward
+        self.episode_move_limit = episode_move_limit
+        self.walls = list(walls)
+        self.wall_map = self.engine.get_wall_map(self.walls)
+        self.origin = np.array(origin, dtype=int)
+
+        # World.update_specials keeps reds then greens, anything else is dropped
+        self.specials = [s for s in specials if s[2] == "red"] + [s for s in specials if s[2] == "green"]
+        xs, ys, colours, rewards, velocities = self.engine.pack_specials(self.specials)
+        self.init_xs, self.init_ys = xs, ys
+        # only red specials move
+        self.init_velocities = np.where(colours == 0, velocities, -1)
+        self.special_rewards = rewards
+
+        self.players = np.tile(self.origin, (n_envs, 1))
+        self.special_xs = np.tile(self.init_xs, (n_envs, 1))
+        self.special_ys = np.tile(self.init_ys, (n_envs, 1))
+        self.special_velocities = np.tile(self.init_velocities, (n_envs, 1))
+        self.scores = np.zeros(n_envs)
+        self.times = np.zeros(n_envs, dtype=int)
+        self.games_played = 0
+
+    def reset(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.n_envs, dtype=bool)
+        self.players[mask] = self.origin
+        self.special_xs[mask] = self.init_xs
+        self.special_ys[mask] = self.init_ys
+        self.special_velocities[mask] = self.init_velocities
+        self.times[mask] = 0
+
+    def step(self, actions):
+        """ Applies actions[i] (names or indices) to game i.
+            Returns <orig_states, rewards, new_states, times, dones> arrays """
+        actions = np.asarray(actions)
+        if actions.dtype.kind not in "iu":
+            actions = np.array([self.actions.index(a) for a in actions], dtype=int)
+        orig_states = self.players.copy()
+        times = self.times.copy()
+        x, y = orig_states[:, 0], orig_states[:, 1]
+
+        # no movement out of terminal states, the first special on the cell is collected
+        on_special = (self.special_xs == x[:, np.newaxis]) & (self.special_ys == y[:, np.newaxis])
+        frozen = on_special.any(axis=1)
+        stand_rewards = self.special_rewards[np.argmax(on_special, axis=1)] if len(self.specials) \
+            else np.zeros(self.n_envs)
+
+        nx, ny, nv = self.engine.move_specials(self.special_xs, self.special_ys,
+                                               self.special_velocities, self.wall_map)
+        moving = ~frozen[:, np.newaxis]
+        self.special_xs = np.where(moving, nx, self.special_xs)
+        self.special_ys = np.where(moving, ny, self.special_ys)
+        self.special_velocities = np.where(moving, nv, self.special_velocities)
+
+        deltas = self.engine.deltas[actions]
+        new_x = x + deltas[:, 0]
+        new_y = y + deltas[:, 1]
+        in_bounds = (new_x >= 0) & (new_x < self.engine.x_dim) & (new_y >= 0) & (new_y < self.engine.y_dim)
+        stay = frozen | ~in_bounds
+        stay[in_bounds] |= self.wall_map[new_x[in_bounds], new_y[in_bounds]]
+        new_x = np.where(stay, x, new_x)
+        new_y = np.where(stay, y, new_y)
+        new_states = np.stack((new_x, new_y), axis=1)
+        self.players = new_states.copy()
+
+        # landing rewards, accumulated special by special like World.try_move
+        rewards = np.full(self.n_envs, self.walk_reward)
+        landed = (self.special_xs == new_x[:, np.newaxis]) & (self.special_ys == new_y[:, np.newaxis])
+        for s in np.flatnonzero(landed.any(axis=0)):
+            rewards = np.where(landed[:, s], rewards - self.walk_reward + self.special_rewards[s], rewards)
+        rewards = np.where(frozen, stand_rewards, rewards)
+        self.scores += rewards
+
+        self.times += 1
+        # a game ends on the cell of a special (terminal, whatever its reward)
+        # or after episode_move_limit moves
+        dones = landed.any(axis=1) | frozen | (self.times > self.episode_move_limit)
+        self.games_played += int(np.sum(dones))
+        self.reset(dones)
+        return orig_states, rewards, new_states, times, dones
+
+    def get_specials(self, env):
+        """ Returns the specials list of game env, in world.World format """
+        return [(int(i), int(j), s[2], s[3], self.engine.velocity_names[v] if v >= 0 else s[4])
+                for i, j, v, s in zip(self.special_xs[env], self.special_ys[env],
+                                      self.special_velocities[env], self.specials)]
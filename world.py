@@ -3,6 +3,7 @@ import time
 import threading
 import numpy as np
 from inputReader import KeyInputHandler
+from gridEngine import GridEngine, WallLayout
 
 static_x_dim, static_y_dim = (10, 7)
 static_time_between_moves = 0.1
@@ -29,7 +30,7 @@ class World(object):
 
     def __init__(self, do_render=True, init_x=None, init_y=None, move_pool=None,
                  input_reader=None, specials=static_specials, walls=static_walls,
-                 do_restart=False, do_belief=False):
+                 do_restart=False, do_belief=False, x_dim=static_x_dim, y_dim=static_y_dim):
         self.do_render = do_render
         if self.do_render: self.master = tk.Tk()
 
@@ -37,7 +38,7 @@ class World(object):
         self.cell_score_min = -0.2
         self.cell_score_max = 0.2
         self.Width = 50
-        self.x, self.y = static_x_dim, static_y_dim
+        self.x, self.y = x_dim, y_dim
         self.actions = ["up", "down", "left", "right"]
         self.do_restart = do_restart
         self.do_belief = do_belief
@@ -49,11 +50,22 @@ class World(object):
         self.score = 0
         self.restart = False
         self.walk_reward = -0.1
+        # headless dynamics, the World only renders and forwards moves
+        self.engine = GridEngine(self.x, self.y, self.walk_reward)
 
+        # bumped by every change of walls, which is stored as a WallLayout
+        self.wall_version = 0
         self.walls = walls
         self.belief_walls = []
         self.original_specials = specials.copy()
-        self.specials = specials
+        # specials are looked up by time in a precomputed trajectory. a
+        # (belief) wall only changes the moves after it is added: the
+        # trajectory is then rebuilt from the specials of that time
+        self.time = 0
+        self.trajectory = None
+        self.trajectory_version = None
+        self.trajectory_start = 0
+        self.start_specials = self.original_specials
         self.belief_states = list()
         self.cell_scores = {}
 
@@ -140,7 +152,7 @@ class World(object):
                                                (x_y_vals[0]+1)*self.Width, (x_y_vals[1]+1)*self.Width,
                                                fill="black", width=1)
         self.board.tag_raise(self.me)
-        self.walls.append((x_y_vals[0], x_y_vals[1]))
+        self.walls = self.walls + ((x_y_vals[0], x_y_vals[1]),)
         self.belief_walls.append(new_rect)
 
     def clear_belief_nodes(self):
@@ -160,12 +172,13 @@ class World(object):
         x_y_vals = list(map(lambda x: int(x), coords.split(',')))
         if not len(x_y_vals) == 2:
             raise Exception("Cannot add belief coord: " + str(coords))
-        for wall in self.walls:
-            if x_y_vals[0] == wall[0] and x_y_vals[1] == wall[1]:
-                return
-        for special in self.specials:
-            if x_y_vals[0] == special[0] and x_y_vals[1] == special[1]:
-                return
+        # wall bitmap and special cell index lookups
+        trajectory = self.get_trajectory()
+        x, y = x_y_vals
+        if (0 <= x < self.x) and (0 <= y < self.y) and trajectory.wall_map[x, y]:
+            return
+        if len(trajectory.get_cell_rewards(x, y, self.trajectory_time)):
+            return
         new_rect = self.board.create_rectangle(x_y_vals[0] * self.Width,
                                                x_y_vals[1] * self.Width,
                                                (x_y_vals[0] + 1) * self.Width,
@@ -252,48 +265,40 @@ class World(object):
         color = "#" + red + green + "00"
         self.board.itemconfigure(triangle, fill=color)
 
+    @property
+    def specials(self):
+        trajectory = self.get_trajectory()
+        return trajectory.at(self.trajectory_time)
+
+    @property
+    def walls(self):
+        return self.wall_layout
+
+    @walls.setter
+    def walls(self, walls):
+        self.wall_layout = WallLayout(walls)
+        self.wall_version += 1
+
+    @property
+    def trajectory_time(self):
+        # time since the start of the current trajectory
+        return self.time - self.trajectory_start
+
+    def get_trajectory(self):
+        if self.trajectory is None or self.trajectory_version != self.wall_version:
+            if self.trajectory is not None and self.time > self.trajectory_start:
+                # the specials keep the moves made under the old walls
+                self.start_specials = self.trajectory.at(self.trajectory_time)
+                self.trajectory_start = self.time
+            self.trajectory = self.engine.get_trajectory(self.start_specials, self.walls)
+            self.trajectory_version = self.wall_version
+        return self.trajectory
+
     def update_specials(self):
         # constant specials
         # return self.specials
-        red_specials = []
-        green_specials = []
-        updated_red_specials = []
-        for special in self.specials:
-            if special[2] == "red":
-                red_specials.append(special)
-            if special[2] == "green":
-                green_specials.append(special)
-        for (i, j, c, w, v) in red_specials:
-            if v == "up":
-                j -= 1
-                if (j >= 0) and (j < self.y) and not ((i, j) in self.walls):
-                    pass # pass, all good
-                else:
-                    v = "down"
-                    j += 2
-            elif v == "down":
-                j += 1
-                if (j >= 0) and (j < self.y) and not ((i, j) in self.walls):
-                    pass  # pass, all good
-                else:
-                    v = "up"
-                    j -= 2
-            elif v == "left":
-                i -= 1
-                if (i >= 0) and (i < self.x) and not ((i, j) in self.walls):
-                    pass  # pass, all good
-                else:
-                    v = "right"
-                    i += 2
-            elif v == "right":
-                i += 1
-                if (i >= 0) and (i < self.x) and not ((i, j) in self.walls):
-                    pass  # pass, all good
-                else:
-                    v = "left"
-                    i -= 2
-            updated_red_specials.append((i, j, c, w, v))
-        return updated_red_specials + green_specials
+        trajectory = self.get_trajectory()
+        return trajectory.at(self.trajectory_time + 1)
 
     def try_move_idx(self, move_idx):
         if move_idx == 0:
@@ -309,23 +314,24 @@ class World(object):
 
     def try_move(self, dx, dy):
         # no movement out of terminal states
-        for (i, j, c, w, v) in self.specials:
-            if self.player[0] == i and self.player[1] == j:
-                if self.do_restart:
-                    print("Restarting game...")
-                    self.restart_game()
-                    print("Game restarted...")
-                    return
-                else:
-                    self.score += w
-                    return
-
-        old_specials = self.specials.copy()
-        self.specials = self.update_specials()
+        trajectory = self.get_trajectory()
+        stand_rewards = trajectory.get_cell_rewards(self.player[0], self.player[1], self.trajectory_time)
+        if len(stand_rewards):
+            if self.do_restart:
+                print("Restarting game...")
+                self.restart_game()
+                print("Game restarted...")
+                return
+            else:
+                self.score += stand_rewards[0]
+                return
+
+        if self.do_render: old_specials = self.specials
+        self.time += 1
         new_x = self.player[0] + dx
         new_y = self.player[1] + dy
         self.score += self.walk_reward
-        if (new_x >= 0) and (new_x < self.x) and (new_y >= 0) and (new_y < self.y) and not ((new_x, new_y) in self.walls):
+        if not self.engine.is_blocked(trajectory.wall_map, new_x, new_y):
             self.player = (new_x, new_y)
 
         if self.do_render:
@@ -357,10 +363,9 @@ class World(object):
                                             width=1)
             self.board.tag_raise(self.me)
 
-        for (i, j, c, w, v) in self.specials:
-            if self.player[0] == i and self.player[1] == j:
-                self.score -= self.walk_reward
-                self.score += w
+        for w in trajectory.get_cell_rewards(self.player[0], self.player[1], self.trajectory_time):
+            self.score -= self.walk_reward
+            self.score += w
 
     def call_up(self, event):
         self.try_move(0, -1)
@@ -376,7 +381,11 @@ class World(object):
 
     def restart_game(self):
         self.player = self.origin
-        self.specials = self.original_specials.copy()
+        self.time = 0
+        # the specials start over, the walls stay
+        self.trajectory = None
+        self.trajectory_start = 0
+        self.start_specials = self.original_specials
         self.restart = False
         if self.do_render:
             self.render_reset_grid()